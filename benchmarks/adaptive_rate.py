@@ -0,0 +1,81 @@
+"""
+Replay an idle night with one 30s walk past the camera at a fixed tick vs `adaptive_rate`
+
+CPU time (excluding rendering the synthetic frames) stands in for power. The idle phase is the
+first 600s, the motion phase is the walk and the 120s after it.
+
+$ python -m benchmarks.adaptive_rate
+"""
+import time
+
+from odonet import cameras
+from benchmarks.scenes import Scene, Clock, use_numpy_metrics
+
+
+TICK_LENGTH = 0.8
+IDLE, WALK, AFTER = 600, 30, 120
+
+
+class ReplayCamera(cameras.BaseCamera):
+
+    def __init__(self, cam_conf, scene, clock):
+        super().__init__(cam_conf)
+        self.scene = scene
+        self.clock = clock
+        self.render_time = 0
+        self.captures = 0
+
+    def capture_frame(self):
+        start = time.process_time()
+        t = self.clock.now - IDLE
+        frame = cameras.Frame(array=self.scene.frame(t / WALK if 0 <= t < WALK else None))
+        self.render_time += time.process_time() - start
+        self.captures += 1
+        return frame
+
+
+def _frame_bytes(frame, decoded):
+    size = len(frame.jpeg) + frame.small.nbytes
+    if decoded or frame._array is not None:
+        size += frame.shape[0] * frame.shape[1] * frame.shape[2]
+    return size
+
+
+def replay(cam_conf):
+    clock = Clock()
+    camera = ReplayCamera(cam_conf, Scene(), clock)
+    # Per phase (idle, walk + after) stats
+    captures, full, cpu = [0, 0], [0, 0], [0.0, 0.0]
+    sent = []
+    held = decoded = 0
+    while clock.now < IDLE + WALK + AFTER:
+        phase = int(clock.now >= IDLE)
+        render_time = camera.render_time
+        start = time.process_time()
+        result = camera.tick()
+        cpu[phase] += time.process_time() - start - (camera.render_time - render_time)
+        captures[phase] += 1
+        full[phase] += camera.motion_scorer.full
+        if result.event is not None:
+            sent.append(len(result.event.images))
+        held = max(held, sum(_frame_bytes(frame, False) for frame, _ in camera.cur_event_images))
+        decoded = max(decoded, sum(_frame_bytes(frame, True) for frame, _ in camera.cur_event_images))
+        clock.now += camera.next_tick_length(TICK_LENGTH)
+    return captures, full, cpu, sent, held, decoded
+
+
+def main():
+    use_numpy_metrics()
+    conf = {'motion': 'auto', 'use_ai': False, 'rate': 1e9}
+    print('{:>9} {:>7} {:>9} {:>12} {:>8} {:>12} {:>14} {:>13}'.format(
+        'mode', 'phase', 'captures', 'full scores', 'cpu (s)', 'event sizes', 'peak event MB', '(if decoded)'))
+    for name, adaptive in [('fixed', False), ('adaptive', True)]:
+        captures, full, cpu, sent, held, decoded = replay(dict(conf, adaptive_rate=adaptive))
+        for phase in range(2):
+            print('{:>9} {:>7} {:>9} {:>12} {:>8.2f} {:>12} {:>14.1f} {:>13.1f}'.format(
+                name, ['idle', 'motion'][phase], captures[phase], full[phase], cpu[phase],
+                ','.join(map(str, sent)), held / 1e6, decoded / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+False positives of the 'auto' motion threshold, frozen after 50 frames (original) vs `MotionThreshold`
+
+Replays synthetic frame sequences, with someone walking past every `WALK_EVERY` frames, through
+`compute_motion_score`.
+
+$ python -m benchmarks.auto_threshold
+"""
+import numpy as np
+
+from odonet import cameras
+from benchmarks.scenes import Scene, use_numpy_metrics
+
+
+FRAMES = 2000
+WALK_EVERY = 400
+WALK_FRAMES = 10
+
+
+class FrozenThreshold:
+    """The original 'auto' threshold, mean + 10 std of the first 50 scores"""
+    def __init__(self):
+        self.history = []
+        self.threshold = 1e9
+
+    def update(self, motion):
+        if len(self.history) > 50:
+            self.threshold = np.mean(self.history) + np.std(self.history) * 10
+        else:
+            self.history.append(motion)
+        return self.threshold
+
+
+def dusk(i):
+    """Sensor noise grows as it gets dark"""
+    return {'noise': 3 + int(12 * i / FRAMES), 'brightness': -int(60 * i / FRAMES)}
+
+
+def lights_off(i):
+    """Lights turn off a third of the way in (darker and noisier)"""
+    if i < FRAMES // 3:
+        return {'noise': 3, 'brightness': 0}
+    return {'noise': 12, 'brightness': -60}
+
+
+def replay(lighting):
+    """Score a sequence, returns [(motion, someone walking in either frame)]"""
+    scene = Scene(300, 300)
+    scores = []
+    last = None
+    was_walking = False
+    for i in range(FRAMES):
+        conditions = lighting(i)
+        scene.noise = conditions['noise']
+        walking = i > 100 and i % WALK_EVERY < WALK_FRAMES
+        img = scene.frame((i % WALK_EVERY) / WALK_FRAMES if walking else None, conditions['brightness'])
+        if last is not None:
+            scores.append((cameras.compute_motion_score(last, img), walking or was_walking))
+        last = img
+        was_walking = walking
+    return scores
+
+
+def evaluate(threshold, scores):
+    false_pos = detected = 0
+    for motion, walking in scores:
+        above = motion > threshold.threshold
+        threshold.update(motion)
+        false_pos += above and not walking
+        detected += above and walking
+    return false_pos, detected
+
+
+def main():
+    use_numpy_metrics()
+    print('{} frames, someone walks past every {}'.format(FRAMES, WALK_EVERY))
+    print('{:>10} {:>10} {:>16} {:>16}'.format('sequence', 'threshold', 'false positives', 'detected frames'))
+    for name, lighting in [('dusk', dusk), ('lights off', lights_off)]:
+        scores = replay(lighting)
+        for threshold_name, threshold in [('frozen', FrozenThreshold()), ('ewma', cameras.MotionThreshold())]:
+            false_pos, detected = evaluate(threshold, scores)
+            print('{:>10} {:>10} {:>16} {:>10} / {:<3}'.format(name, threshold_name, false_pos, detected,
+                                                               sum(moving for _, moving in scores)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Time MobileNetSSD labeling of a 16 frame event at batch sizes 1 through 16
+
+Needs the model files in dnn/ (see dnn/README.md).
+
+$ python -m benchmarks.batch_detection
+"""
+import timeit
+import sys
+
+from odonet import cameras
+from benchmarks.scenes import Scene
+
+
+FRAMES = 16
+
+
+def main():
+    if getattr(cameras, 'mobile_net', None) is None:
+        print('MobileNetSSD not loaded (see dnn/README.md)')
+        sys.exit(1)
+
+    scene = Scene()
+    frames = [cameras.Frame(array=scene.frame(i / FRAMES)) for i in range(FRAMES)]
+    images = [frame.small for frame in frames]
+    shapes = [frame.shape for frame in frames]
+
+    print('{} frame event, best of 3'.format(FRAMES))
+    print('{:>10} {:>10} {:>10} {:>8}'.format('batch', 'ms/event', 'ms/frame', 'speedup'))
+    base = None
+    for batch_size in [1, 2, 4, 8, 16]:
+        label = lambda: cameras.detect_objs_batch(images, output_shapes=shapes, batch_size=batch_size)
+        label() # warm up
+        best = min(timeit.repeat(label, number=1, repeat=3))
+        base = base or best
+        print('{:>10} {:>10.1f} {:>10.1f} {:>7.1f}x'.format(batch_size, best * 1000, best * 1000 / FRAMES, base / best))
+
+
+if __name__ == '__main__':
+    main()
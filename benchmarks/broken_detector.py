@@ -0,0 +1,47 @@
+"""
+Time BrokenDetector against the original row loop on a SMALL_DIM frame
+
+$ python -m benchmarks.broken_detector
+"""
+import timeit
+
+import numpy as np
+
+from odonet import cameras
+from benchmarks.scenes import Scene
+
+
+def legacy_is_broken(img):
+    """The original `cameras.is_broken`"""
+    h, w = img.shape[:2]
+
+    for i in range(0, h - 3, 3):
+        row1 = np.sum(img[i, :, :])
+        row2 = np.sum(img[i + 1, :, :])
+        row3 = np.sum(img[i + 2, :, :])
+        if row1 == row2 == row3:
+            return True
+
+    return False
+
+
+def main():
+    img = cameras.Frame(array=Scene().frame(0.5)).small
+    checks = [
+        ('legacy loop', legacy_is_broken),
+        ('default', cameras.BrokenDetector().check),
+        ('all checks', cameras.BrokenDetector(columns=True, grey_rows=8, frozen=10).check)
+    ]
+    print('{}x{} frame, best of 5'.format(img.shape[1], img.shape[0]))
+    print('{:>12} {:>10} {:>8}'.format('check', 'ms/frame', 'speedup'))
+    base = None
+    for name, check in checks:
+        assert not check(img)
+        runs = 200
+        best = min(timeit.repeat(lambda: check(img), number=runs, repeat=5)) / runs
+        base = base or best
+        print('{:>12} {:>10.3f} {:>7.1f}x'.format(name, best * 1000, base / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Binary event format vs pickling `Event` objects
+
+$ python -m benchmarks.event_format
+"""
+import tempfile
+import pickle
+import timeit
+import os
+
+import numpy as np
+import cv2
+
+from odonet import events
+from benchmarks.scenes import Scene
+
+
+FRAMES = 16
+
+
+def make_event():
+    scene = Scene()
+    event = events.Event()
+    event.node = 'A'
+    for i in range(FRAMES):
+        _, img_data = cv2.imencode('.jpg', scene.frame(i / FRAMES))
+        person = events.EventObject('person', bbox=np.array([100 + i, 200, 300 + i, 600]))
+        event.add_image_data(img_data.tobytes(), objects=[person], motion=150 + i)
+    events.score(event)
+    return event
+
+
+def _best(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def main():
+    event = make_event()
+    pickled = pickle.dumps(event)
+    encoded = events.encode_event(event)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pkl_fn = os.path.join(tmp_dir, 'event.pkl')
+        bin_fn = os.path.join(tmp_dir, 'event.bin')
+        with open(pkl_fn, 'wb') as f:
+            f.write(pickled)
+        with open(bin_fn, 'wb') as f:
+            f.write(encoded)
+
+        def pickle_meta():
+            with open(pkl_fn, 'rb') as f:
+                return pickle.load(f).score
+
+        def bin_meta():
+            with open(bin_fn, 'rb') as f:
+                return events.read_event_meta(f)[0]['score']
+
+        rows = [
+            ('pickle', len(pickled), _best(lambda: pickle.dumps(event), 50),
+             _best(lambda: pickle.loads(pickled), 50), _best(pickle_meta, 50)),
+            ('binary', len(encoded), _best(lambda: events.encode_event(event), 50),
+             _best(lambda: events.decode_event(encoded), 50), _best(bin_meta, 50))
+        ]
+
+    print('{} frame event'.format(FRAMES))
+    print('{:>8} {:>9} {:>11} {:>11} {:>17}'.format('format', 'size MB', 'encode ms', 'decode ms', 'meta from disk ms'))
+    for name, size, encode, decode, meta in rows:
+        print('{:>8} {:>9.2f} {:>11.3f} {:>11.3f} {:>17.3f}'.format(name, size / 1e6, encode * 1000, decode * 1000, meta * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+FTP camera ingest rate, in memory (FTPCamera) vs writing each upload to disk and reading it back
+
+Run it from the disk the node uses (ex. the SD card) since the disk version writes to the cwd.
+
+$ python -m benchmarks.ftp_ingest
+"""
+import threading
+import tempfile
+import logging
+import ftplib
+import socket
+import queue
+import time
+import os
+import io
+
+import cv2
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+from odonet import cameras
+from benchmarks.scenes import Scene
+
+
+UPLOADS = 200
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class DiskFTPCamera:
+
+    def __init__(self, port, buffer_size=3):
+        """The old FTPCamera ingest: uploads are written to the cwd, read back and deleted"""
+        self.ftp_port = port
+        self.img_buffer = queue.Queue(buffer_size)
+        self.received = 0
+
+        auth = DummyAuthorizer()
+        auth.add_user('user', '12345', os.getcwd(), perm='elradfmwMT')
+
+        this = self
+        class CamHandler(FTPHandler):
+            def on_file_received(ftp_self, fn):
+                if fn.endswith('.jpg'):
+                    with open(fn, 'rb') as f:
+                        img_data = f.read()
+                    if this.img_buffer.full():
+                        this.img_buffer.get()
+                    this.img_buffer.put(img_data)
+                    this.received += 1
+                os.remove(fn)
+
+        CamHandler.authorizer = auth
+        self.server = FTPServer(('127.0.0.1', port), CamHandler)
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.thread.join(5)
+
+    def _serve(self):
+        while self.running:
+            self.server.ioloop.loop(timeout=0.5, blocking=False)
+        self.server.close_all()
+
+
+def ingest(camera, img_data):
+    ftp = ftplib.FTP()
+    ftp.connect('127.0.0.1', camera.ftp_port)
+    ftp.login('user', '12345')
+    start = time.perf_counter()
+    for i in range(UPLOADS):
+        ftp.storbinary('STOR {}.jpg'.format(i), io.BytesIO(img_data))
+    while camera.received < UPLOADS:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    ftp.quit()
+    return elapsed
+
+
+def main():
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    _, img_data = cv2.imencode('.jpg', Scene().frame(0.5))
+    img_data = img_data.tobytes()
+
+    print('{} uploads of a {:.0f}KB 720p JPEG'.format(UPLOADS, len(img_data) / 1024))
+    print('{:>8} {:>10} {:>8}'.format('ingest', 'frames/s', 'MB/s'))
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(dir=cwd) as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            for name, make in [('disk', DiskFTPCamera),
+                               ('memory', lambda port: cameras.FTPCamera({'_my_ip': '127.0.0.1', 'port': port}))]:
+                camera = make(_free_port())
+                try:
+                    elapsed = ingest(camera, img_data)
+                finally:
+                    camera.close()
+                print('{:>8} {:>10.1f} {:>8.1f}'.format(name, UPLOADS / elapsed, UPLOADS * len(img_data) / elapsed / 1e6))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Snapshot latency from a stand-in Insteon camera, `requests.get` per snapshot (original) vs the camera's session
+
+$ python -m benchmarks.http_snapshots
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import concurrent.futures
+import threading
+import logging
+import time
+
+import requests
+import cv2
+
+from odonet import cameras
+from benchmarks.scenes import Scene
+
+
+SNAPSHOTS = 300
+CAMERAS = 4
+
+
+class SnapshotHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive like the cameras
+    disable_nagle_algorithm = True # the headers and body are separate writes
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.server.snapshot)))
+        self.end_headers()
+        self.wfile.write(self.server.snapshot)
+
+    def log_message(self, *args):
+        pass
+
+
+def _per_snapshot(fetch, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        assert fetch() is not None
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    logging.disable(logging.INFO)
+    _, snapshot = cv2.imencode('.jpg', cv2.resize(Scene().frame(0.5), (640, 480)))
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SnapshotHandler)
+    server.daemon_threads = True
+    server.snapshot = snapshot.tobytes()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    conf = {'ip': '127.0.0.1', 'port': server.server_address[1]}
+    cams = [cameras.Insteon_75790(conf) for _ in range(CAMERAS)]
+    url = 'http://127.0.0.1:{}/snapshot.cgi?user=admin&pwd='.format(server.server_address[1])
+
+    print('{} snapshots of {:.0f}KB'.format(SNAPSHOTS, len(server.snapshot) / 1024))
+    print('{:>22} {:>12}'.format('fetch', 'ms/snapshot'))
+
+    rows = [('requests.get', lambda: requests.get(url, timeout=5).content),
+            ('session', cams[0].capture)]
+    for name, fetch in rows:
+        fetch() # warm up
+        print('{:>22} {:>12.2f}'.format(name, _per_snapshot(fetch, SNAPSHOTS) * 1000))
+
+    # Each camera ticks on its own DeviceLoop thread
+    with concurrent.futures.ThreadPoolExecutor(CAMERAS) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda cam: _per_snapshot(cam.capture, SNAPSHOTS // CAMERAS), cams))
+        elapsed = time.perf_counter() - start
+    print('{:>22} {:>12.2f}'.format('{} sessions at once'.format(CAMERAS), elapsed / SNAPSHOTS * 1000))
+
+    for cam in cams:
+        cam.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Peak memory and throughput reading a 5MB image packet, the original reader vs `read_encoded_socket`
+
+$ python -m benchmarks.packet_decode
+"""
+import tracemalloc
+import threading
+import logging
+import socket
+import struct
+import time
+
+from odonet import network_util
+from odonet.network_util import DataType
+
+
+SIZE = 5 * 1024 * 1024
+ROUNDS = 50
+
+
+def legacy_read_encoded_socket(sock, reader_id='', decode_iif_mine=False):
+    """The original reader (only the image path)"""
+    data = bytearray(sock.recv(20))
+
+    if len(data) == 0:
+        return '', b'', None
+
+    content_index = data.index(b'=')
+    packet_size, data_type = struct.unpack('IH', data[content_index + 1:content_index + 7])
+    header_size = content_index + 6 + 1
+    bytes_left = packet_size + header_size - len(data)
+
+    while bytes_left > 0:
+        buff = sock.recv(bytes_left)
+        data.extend(buff)
+        bytes_left -= len(buff)
+
+    address = str(data[:content_index], 'ascii')
+
+    id = struct.unpack('H', data[header_size:header_size+2])[0]
+    image_data = bytes(data[header_size+2:])
+    decoded = {'current_image': image_data, 'cam': id}
+
+    return address, data, decoded
+
+
+def _read(read, packet, rounds):
+    """Read `packet` `rounds` times over a socketpair, returns (secs, peak bytes allocated while reading)"""
+    reader, writer = socket.socketpair()
+    sender = threading.Thread(target=lambda: [writer.sendall(packet) for _ in range(rounds)])
+    sender.daemon = True
+    sender.start()
+
+    peak = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        result = read(reader)
+        if tracemalloc.is_tracing():
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+        assert len(result[2]['current_image']) == SIZE
+        del result
+    elapsed = time.perf_counter() - start
+
+    sender.join()
+    reader.close()
+    writer.close()
+    return elapsed, peak
+
+
+def main():
+    logging.disable(logging.INFO)
+    packet = network_util.construct_packet('A', DataType.IMAGE, struct.pack('H', 0) + bytes(SIZE))
+    readers = [('original', legacy_read_encoded_socket), ('recv_into', network_util.read_encoded_socket)]
+
+    print('{:.0f}MB image packet over a socketpair'.format(SIZE / 1024 / 1024))
+    print('{:>10} {:>10} {:>14}'.format('reader', 'MB/s', 'peak alloc MB'))
+    for name, read in readers:
+        elapsed, _ = _read(read, packet, ROUNDS)
+        tracemalloc.start()
+        _, peak = _read(read, packet, 3)
+        tracemalloc.stop()
+        print('{:>10} {:>10.0f} {:>14.1f}'.format(name, ROUNDS * len(packet) / elapsed / 1e6, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
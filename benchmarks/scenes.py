@@ -0,0 +1,93 @@
+"""
+Synthetic frames and a simulated clock for the benchmarks
+"""
+from datetime import datetime, timedelta
+import logging
+
+import numpy as np
+import cv2
+
+from odonet import cameras, events
+
+
+def use_numpy_metrics():
+    """Score motion with numpy versions of the skimage metrics if skimage isn't installed"""
+    if hasattr(cameras, 'compare_ssim'):
+        return
+
+    def nrmse(a, b):
+        a, b = a.astype(np.float64), b.astype(np.float64)
+        return np.sqrt(np.mean((a - b) ** 2)) / np.sqrt(np.mean(a ** 2))
+
+    def ssim(a, b, multichannel=True):
+        a, b = a.astype(np.float64), b.astype(np.float64)
+        c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+        blur = lambda img: cv2.GaussianBlur(img, (7, 7), 1.5)
+        mu_a, mu_b = blur(a), blur(b)
+        var_a = blur(a * a) - mu_a ** 2
+        var_b = blur(b * b) - mu_b ** 2
+        cov = blur(a * b) - mu_a * mu_b
+        return (((2 * mu_a * mu_b + c1) * (2 * cov + c2)) /
+                ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))).mean()
+
+    logging.warning('Skimage not found, using numpy SSIM/NRMSE (absolute times will differ).')
+    cameras.compare_nrmse = nrmse
+    cameras.compare_ssim = ssim
+
+
+class Scene:
+
+    def __init__(self, width=1280, height=720, noise=3, flicker=1, seed=0):
+        """
+        A static textured scene with an object that can move across it.
+
+        noise: max per pixel sensor noise
+        flicker: std of the per frame brightness change (exposure/lighting)
+        """
+        rng = np.random.RandomState(seed)
+        self.rng = rng
+        self.noise = noise
+        self.flicker = flicker
+        self.background = cv2.GaussianBlur(rng.randint(0, 255, (height, width, 3)).astype(np.uint8), (9, 9), 3)
+        self.object = rng.randint(0, 255, (height // 2, width // 3, 3)).astype(np.uint8)
+
+
+    def frame(self, x=None, brightness=0):
+        """The scene with the object's left edge at `x` (a fraction of the width, None for no object)"""
+        img = self.background.copy()
+        if x is not None:
+            h, w = self.object.shape[:2]
+            left = int(x * (img.shape[1] - w))
+            top = img.shape[0] // 4
+            img[top:top + h, left:left + w] = self.object
+        if self.flicker:
+            brightness += int(round(self.rng.normal(0, self.flicker)))
+        if brightness > 0:
+            img = cv2.add(img, np.full(img.shape, brightness, np.uint8))
+        elif brightness < 0:
+            img = cv2.subtract(img, np.full(img.shape, -brightness, np.uint8))
+        if self.noise:
+            img = cv2.add(img, self.rng.randint(0, self.noise, img.shape, dtype=np.uint8))
+        return img
+
+
+class Clock:
+
+    def __init__(self):
+        """Replace `time.time`/`datetime.now` in cameras and events so replays run faster than real time"""
+        self.now = 0.0
+        clock = self
+
+        class ClockTime:
+            @staticmethod
+            def time():
+                return clock.now
+
+        class ClockDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return datetime(2020, 1, 1) + timedelta(seconds=clock.now)
+
+        cameras.time = ClockTime
+        cameras.datetime = ClockDatetime
+        events.datetime = ClockDatetime
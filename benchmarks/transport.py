@@ -0,0 +1,48 @@
+"""
+Packets per second over one hop, a new socket per packet (`send_packet`) vs a persistent `Connection`
+
+$ python -m benchmarks.transport
+"""
+import socketserver
+import time
+
+from odonet import network_util
+
+
+PACKETS = [('ping', network_util.DataType.TEXT, 'ping', 2000),
+           ('64KB image', network_util.DataType.IMAGE, bytes(64 * 1024), 500)]
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        network_util.handle_connection(self.request, lambda address, data, decoded, max_replies: [], timeout=10)
+
+
+def main():
+    with network_util.create_server('127.0.0.1', 0, Handler) as server:
+        port = server.server_address[1]
+        conn = network_util.Connection('127.0.0.1', port)
+
+        transports = [
+            ('per packet', lambda packet: network_util.send_packet('A', '127.0.0.1', port, packet)),
+            ('persistent', lambda packet: conn.send_packet('A', packet))
+        ]
+
+        print('{:>12} {:>12} {:>10} {:>8}'.format('packet', 'transport', 'packets/s', 'speedup'))
+        for name, data_type, msg, count in PACKETS:
+            packet = network_util.construct_packet('', data_type, msg)
+            base = None
+            for transport, send in transports:
+                send(packet) # warm up
+                start = time.perf_counter()
+                for _ in range(count):
+                    send(packet)
+                rate = count / (time.perf_counter() - start)
+                base = base or rate
+                print('{:>12} {:>12} {:>10.0f} {:>7.1f}x'.format(name, transport, rate, rate / base))
+
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
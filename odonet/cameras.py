@@ -1,10 +1,12 @@
 """
 Cameras
 """
+from collections import deque
 from datetime import datetime
 import subprocess
 import threading
 import requests
+import weakref
 import tempfile
 import logging
 import queue
@@ -29,6 +31,9 @@ DNN_MODEL = (
 # **Must be 300x300 for MobileNetSSD.
 SMALL_DIM = (300, 300)
 
+# mobile_net is shared by all the cameras, setInput() and forward() must happen together
+mobile_net_lock = threading.Lock()
+
 ## Optional Imports ##
 
 try:
@@ -62,6 +67,7 @@ except ImportError:
 
 try:
     from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.filesystems import AbstractedFS
     from pyftpdlib.handlers import FTPHandler
     from pyftpdlib.servers import FTPServer
 except ImportError:
@@ -81,27 +87,76 @@ class BaseCamera(devices.Device):
         self.mode = cam_conf.get('mode', 'monitor')
         self.monitor_rate = cam_conf.get('rate', 15 * 60)
         self.use_ai = cam_conf.get('use_ai', True)
+        self.ai_batch_size = cam_conf.get('ai_batch_size', 16)
         self.check_broken = cam_conf.get('check_broken', True)
         self.motion = cam_conf.get('motion', 'auto')
+        self.motion_auto = cam_conf.get('motion_auto', {})
+        self.motion_prefilter = cam_conf.get('motion_prefilter', True)
+        self.adaptive_rate = cam_conf.get('adaptive_rate', False)
+        self.roi = cam_conf.get('roi')
+        self.exclude = cam_conf.get('exclude')
         self.max_event_age = cam_conf.get('max_event_age', 60)
         self.max_event_size = cam_conf.get('max_event_size', 16)
+        self.pre_roll = cam_conf.get('pre_roll', 0)
+        self.pre_roll_kb = cam_conf.get('pre_roll_kb', 512)
 
         # state vars
         self.cur_event = None
         self.cur_event_images = []
         self.time_last_sent = -1e9
-        self.last_img = None
-        self.last_img_small = None
+        self.last_frame = None
+        self.last_img_roi = None
         self.reset_prev_frame = False
+        self.reference_rois = deque()
+        self.tick_length = None
+
+        # Set by the node to label events off the tick loop
+        self.detection_worker = None
 
         if self.motion == 'auto':
-            self.motion_history = []
-            self.motion_threshold = 1e9
+            self.auto_threshold = MotionThreshold(**self.motion_auto)
+            self.motion_threshold = self.auto_threshold.threshold
         else:
             self.motion_threshold = self.motion
 
         self.motion_coef = 1
 
+        # `check_broken` can be a bool or a dict of BrokenDetector options
+        if isinstance(self.check_broken, dict):
+            self.broken_detector = BrokenDetector(**self.check_broken)
+        elif self.check_broken:
+            self.broken_detector = BrokenDetector()
+        else:
+            self.broken_detector = None
+
+        # `motion_prefilter` can be a bool or a dict of MotionScorer options
+        if isinstance(self.motion_prefilter, dict):
+            self.motion_scorer = MotionScorer(**self.motion_prefilter)
+        elif self.motion_prefilter:
+            self.motion_scorer = MotionScorer()
+        else:
+            self.motion_scorer = None
+
+        # Only look for motion/objects in these polygons
+        if self.roi or self.exclude:
+            self.region = MotionRegion(self.roi, self.exclude)
+        else:
+            self.region = None
+
+        # Keep the frames from before events
+        if self.pre_roll > 0:
+            self.pre_roll_buffer = PreRollBuffer(self.pre_roll, self.pre_roll_kb)
+        else:
+            self.pre_roll_buffer = None
+
+        # `adaptive_rate` can be a bool or a dict of AdaptiveRate options
+        if isinstance(self.adaptive_rate, dict):
+            self.rate_scheduler = AdaptiveRate(**self.adaptive_rate)
+        elif self.adaptive_rate:
+            self.rate_scheduler = AdaptiveRate()
+        else:
+            self.rate_scheduler = None
+
 
     def capture(self):
         """Capture image as raw bytes"""
@@ -110,10 +165,19 @@ class BaseCamera(devices.Device):
 
     def capture_array(self):
         """Capture image as 3D array"""
+        frame = self.capture_frame()
+        if frame is None:
+            return None
+        return frame.array
+
+
+    def capture_frame(self):
+        """Capture a `Frame` (by default from the JPEG `capture`)"""
         img_data = self.capture()
         if img_data:
-            ary = np.fromstring(img_data, np.uint8)
-            return cv2.imdecode(ary, cv2.IMREAD_COLOR)
+            if self.broken_detector is not None and self.broken_detector.check_jpeg(img_data):
+                return None
+            return Frame(jpeg=img_data)
         return None
 
 
@@ -159,94 +223,169 @@ class BaseCamera(devices.Device):
 
         result = devices.TickResult()
 
-        if self.last_img is None or self.reset_prev_frame:
+        if self.last_frame is None or self.reset_prev_frame:
+
+            self.last_frame = self.capture_frame()
+
+            if self.last_frame is None or self.last_frame.array is None:
+                self.last_frame = None
+                return result
 
-            self.last_img = self.capture_array()
-            self.last_img_small = cv2.resize(self.last_img, SMALL_DIM)
+            self.last_img_roi = self._roi(self.last_frame.small)
             self.reset_prev_frame = False
 
-            if self.check_broken and is_broken(self.last_img_small):
-                self.last_img = None
+            self.reference_rois.clear()
+            if self.rate_scheduler is not None:
+                self.reference_rois.append((time_now, self.last_img_roi))
+
+            if self._is_broken(self.last_frame.small):
+                self.last_frame = None
 
         else:
 
-            cur_img = self.capture_array()
+            cur_frame = self.capture_frame()
 
-            if cur_img is None:
+            if cur_frame is None or cur_frame.array is None:
                 return result
 
-            cur_img_small = cv2.resize(cur_img, SMALL_DIM)
-
-            if self.check_broken and is_broken(cur_img_small):
+            if self._is_broken(cur_frame.small):
                 return result
 
-            motion = compute_motion_score(self.last_img_small, cur_img_small)
+            cur_img_roi = self._roi(cur_frame.small)
 
             # Collecting data to determine 'auto' threshold
-            if self.motion == 'auto' and self.motion_threshold == 1e9:
-
-                if len(self.motion_history) > 50:
-                    motion_data = np.array(self.motion_history)
-                    avg = np.mean(motion_data)
-                    std = np.std(motion_data)
-                    self.motion_threshold = avg + std * 10
+            collecting = self.motion == 'auto' and not self.auto_threshold.ready
+
+            ref_img_roi = self._reference_roi(time_now, cur_img_roi)
+
+            if self.motion_scorer is None:
+                motion = compute_motion_score(ref_img_roi, cur_img_roi)
+            elif collecting: # use the full score to calibrate the threshold and prefilter
+                motion = self.motion_scorer.score(ref_img_roi, cur_img_roi)
+            else:
+                motion = self.motion_scorer.score(ref_img_roi, cur_img_roi,
+                                                  threshold=self.motion_threshold * self.motion_coef)
+
+            # The prefilter's estimate isn't on the same scale, only learn from full scores
+            full_score = self.motion_scorer is None or self.motion_scorer.full
+            if self.motion == 'auto' and full_score:
+                self.motion_threshold = self.auto_threshold.update(motion)
+                if collecting and self.auto_threshold.ready:
                     logging.info('Motion threshold set to {}'.format(self.motion_threshold))
-                else:
-                    self.motion_history.append(motion)
 
             # Motion detected?
             if motion > self.motion_threshold * self.motion_coef:
 
                 if self.cur_event is None: # Create new event
                     self.cur_event = events.Event()
-                    self.cur_event_images.append((date_now, self.last_img, self.last_img_small, motion))
+                    if self.pre_roll_buffer is not None: # the last frame is already in the pre-roll
+                        for date, image_data, frame_motion in self.pre_roll_buffer.pop_all():
+                            self.cur_event.add_image_data(image_data, date=date, motion=frame_motion)
+                    else:
+                        self.cur_event_images.append((self.last_frame.compact(), motion))
 
                 elif self.motion == 'auto': # if already event and 'auto', temp lower the detection threshold
                      self.motion_coef = 0.7
 
-                self.cur_event_images.append((date_now, cur_img, cur_img_small, motion))
+                # Events can hold many frames, don't keep them all decoded
+                self.cur_event_images.append((cur_frame.compact(), motion))
+
+            if self.rate_scheduler is not None:
+                self.rate_scheduler.update(motion, self.motion_threshold * self.motion_coef, self.cur_event is not None)
 
-            self.last_img = cur_img
-            self.last_img_small = cur_img_small
+            if self.pre_roll_buffer is not None and self.cur_event is None:
+                self.pre_roll_buffer.push(cur_frame.date, cur_frame.jpeg, motion)
+
+            self.last_frame = cur_frame
+            self.last_img_roi = cur_img_roi
 
         # Check if the current event is old/should be sent to root
         if self._expired_event(self.cur_event):
 
-            # Label stored images and use object detection
-            for date, image_array, small_array, motion in self.cur_event_images:
-
-                if self.use_ai:
-                    detected = detect_objs(small_array, output_shape=image_array.shape)
+            try:
+                # Label stored images and use object detection
+                if self.use_ai and self.detection_worker is not None:
+                    queued = self.detection_worker.submit(self.cur_event, self.cur_event_images,
+                                                          self.ai_batch_size, self.region)
+                    use_ai = False # if the worker is backed up, send it w/o detection
                 else:
-                    detected = []
-
-                self.cur_event.add_image(image_array, date=date, objects=detected, motion=motion)
+                    queued = False
+                    use_ai = self.use_ai
 
-            # Compute the event's score
-            events.score(self.cur_event)
-
-            logging.info('Sending Event {}'.format(self.cur_event))
-
-            result.event = self.cur_event
+                if queued:
+                    logging.info('Queued Event {}'.format(self.cur_event))
+                else:
+                    label_event_safe(self.cur_event, self.cur_event_images, use_ai, self.ai_batch_size, self.region)
+                    logging.info('Sending Event {}'.format(self.cur_event))
+                    result.event = self.cur_event
 
-            # Reset event state
-            self.cur_event = None
-            self.cur_event_images = []
-            self.motion_coef = 1
+            finally:
+                # Reset event state (even if labeling failed so it isn't retried every tick)
+                self.cur_event = None
+                self.cur_event_images = []
+                self.motion_coef = 1
 
         # Check if snapshot should be updated
         if time_now - self.time_last_sent >= self.monitor_rate:
 
             self.time_last_sent = time_now
-            result.image = self.capture()
+            if self.last_frame is not None: # reuse this tick's capture
+                result.image = self.last_frame.jpeg
+            else:
+                result.image = self.capture()
 
         return result
 
 
+    def stats(self):
+        # The root uses the mode to decide how to show current images
+        return {'mode': self.mode}
+
+
+    def next_tick_length(self, tick_length):
+        self.tick_length = tick_length
+        if self.mode == 'monitor' and self.rate_scheduler is not None:
+            return self.rate_scheduler.interval
+        return tick_length
+
+
+    def _roi(self, img_small):
+        if self.region is None:
+            return img_small
+        return self.region.apply(img_small)
+
+
+    def _is_broken(self, img_small):
+        if self.broken_detector is None:
+            return False
+        return self.broken_detector.check(img_small)
+
+
     def _expired_event(self, event):
         if event is None:
             return False
-        return event.age > self.max_event_age or len(self.cur_event_images) > self.max_event_size
+        return event.age > self.max_event_age or len(self.cur_event_images) > self._max_event_frames()
+
+
+    def _max_event_frames(self):
+        # `max_event_size` is in ticks of `tick_length`, scale it up for the faster adaptive ticks
+        if self.rate_scheduler is None or not self.tick_length:
+            return self.max_event_size
+        return int(self.max_event_size * max(1, self.tick_length / self.rate_scheduler.min_tick))
+
+
+    def _reference_roi(self, time_now, cur_img_roi):
+        """Pick the previous frame to score motion against"""
+        if self.rate_scheduler is None:
+            return self.last_img_roi
+        # Use the newest frame at least `max_tick` old so scores span about the same time
+        # at every tick rate and one threshold fits all of them
+        refs = self.reference_rois
+        while len(refs) > 1 and time_now - refs[1][0] >= self.rate_scheduler.max_tick:
+            refs.popleft()
+        ref_img_roi = refs[0][1] if refs else self.last_img_roi
+        refs.append((time_now, cur_img_roi))
+        return ref_img_roi
 
 
 class RaspberryPiCamera(BaseCamera):
@@ -262,10 +401,10 @@ class RaspberryPiCamera(BaseCamera):
         time.sleep(1)
 
 
-    def capture_array(self):
+    def capture_frame(self):
         pixels = PiRGBArray(self.camera)
         self.camera.capture(pixels, format="bgr")
-        return pixels.array
+        return Frame(array=pixels.array)
 
     def capture(self):
         buffer = io.BytesIO()
@@ -290,11 +429,6 @@ class FSWebcam(BaseCamera):
         subprocess.call(self.cmd, shell=True)
 
 
-    def capture_array(self):
-        self._take_pic()
-        return cv2.imread(self.temp_img)
-
-
     def capture(self):
         self._take_pic()
         with open(self.temp_img, 'rb') as image_file:
@@ -317,25 +451,38 @@ class Insteon_75790(BaseCamera):
         self.cam_user = cam_conf.get('username', 'admin')
         self.cam_pass = cam_conf.get('password', '')
         self.move_dist = cam_conf.get('movement', 1)
+        self.timeout = cam_conf.get('timeout', 5)
+
+        # Reuse connections to the camera (keep-alive)
+        self.session = requests.Session()
 
         self.capture()
         logging.info('Found Insteon 75790 Camera')
 
 
     def _send_request(self, url_data):
-        return requests.get('http://{}:{}/{}user={}&pwd={}'.format(self.cam_ip, self.cam_port, url_data, self.cam_user, self.cam_pass))
+        return self.session.get('http://{}:{}/{}user={}&pwd={}'.format(self.cam_ip, self.cam_port, url_data, self.cam_user, self.cam_pass),
+                                timeout=self.timeout)
 
 
     def move(self, dir):
-        move_id = InsteonIPCam.MOVES[dir]
+        move_id = Insteon_75790.MOVES[dir]
         self._send_request('decoder_control.cgi?command={}&'.format(move_id))
         time.sleep(self.move_dist)
         self._send_request('decoder_control.cgi?command={}&'.format(1))
         self.reset_prev_frame = True
 
 
+    def close(self):
+        self.session.close()
+
+
     def capture(self):
-        req = self._send_request('snapshot.cgi?')
+        try:
+            req = self._send_request('snapshot.cgi?')
+        except requests.RequestException as e:
+            logging.warning('Insteon snapshot failed: {}'.format(e))
+            return None
         return req.content
 
 
@@ -344,27 +491,55 @@ class OpenCVCamera(BaseCamera):
     def __init__(self, cam_conf):
         super().__init__(cam_conf)
         self.url = cam_conf.get('url', 0)
-        self.cap = cv2.VideoCapture(self.url)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 5);
+        self.grab_latest = cam_conf.get('grab_latest', True)
+
+        # Read frames on a seperate thread so they don't get stale waiting in the buffer
+        if self.grab_latest:
+            self.grabber = FrameGrabber(self.url)
+        else:
+            self.grabber = None
+            self.cap = cv2.VideoCapture(self.url)
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 5);
+            self.capture()
 
-        self.capture()
         logging.info('Found OpenCV VideoCapture')
 
 
     def ready(self):
+        if self.grabber is not None:
+            return self.grabber.has_new()
         return self.cap.isOpened()
 
 
-    def capture_array(self):
-        ret, frame = self.cap.read()
-        if ret:
-            return frame
+    def close(self):
+        if self.grabber is not None:
+            self.grabber.stop()
+
+
+    def stats(self):
+        stats = super().stats()
+        if self.grabber is not None:
+            stats.update(self.grabber.stats())
+        return stats
+
+
+    def capture_frame(self):
+        if self.grabber is not None:
+            frame = self.grabber.read()
+        else:
+            ret, frame = self.cap.read()
+            if not ret:
+                frame = None
+        if frame is not None:
+            return Frame(array=frame)
         return None
 
 
     def capture(self):
-        _, img_data = cv2.imencode('.jpg', self.capture_array())
-        return img_data.tostring()
+        frame = self.capture_frame()
+        if frame is None:
+            return None
+        return frame.jpeg
 
 
 class RTSPCamera(OpenCVCamera):
@@ -384,20 +559,104 @@ class RTSPCamera(OpenCVCamera):
         super().__init__(cam_conf)
 
 
-    def ready(self):
-        return self.cap.isOpened()
+class FrameGrabber:
 
+    def __init__(self, url, reconnect_delay=2, max_failures=10):
+        """
+        Continuously read a cv2.VideoCapture on a background thread keeping only the newest frame.
 
-    def capture_array(self):
-        ret, frame = self.cap.read()
-        if ret:
-            return frame
-        return None
+        reconnect_delay: secs to wait before reopening a closed/failing stream
+        max_failures: # of failed reads in a row before reconnecting
+        """
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.max_failures = max_failures
 
+        # (frame, time read, seq) swapped as a whole so readers don't need a lock
+        self.latest = (None, 0, 0)
+        self.last_read_seq = 0
 
-    def capture(self):
-        _, img_data = cv2.imencode('.jpg', self.capture_array())
-        return img_data.tostring()
+        self.frames = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+        self.cap = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def has_new(self):
+        return self.latest[2] != self.last_read_seq
+
+
+    def read(self):
+        """Get the newest frame (None if it was already read)"""
+        frame, read_time, seq = self.latest
+        if seq == self.last_read_seq:
+            return None
+        self.last_read_seq = seq
+        return frame
+
+
+    def age(self):
+        """Secs since the newest frame was read from the stream"""
+        frame, read_time, seq = self.latest
+        if frame is None:
+            return None
+        return time.time() - read_time
+
+
+    def stats(self):
+        age = self.age()
+        return {
+            'age': None if age is None else round(age, 3),
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'reconnects': self.reconnects
+        }
+
+
+    def stop(self):
+        self.running = False
+
+
+    def _open(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.reconnects += 1
+            logging.warning('Reconnecting to {}'.format(self.url))
+            time.sleep(self.reconnect_delay)
+        self.cap = cv2.VideoCapture(self.url)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+
+    def _run(self):
+        failures = 0
+        self._open()
+        while self.running:
+
+            if not self.cap.isOpened() or failures >= self.max_failures:
+                failures = 0
+                self._open()
+                continue
+
+            ret, frame = self.cap.read()
+            if not ret:
+                failures += 1
+                time.sleep(0.01)
+                continue
+
+            failures = 0
+            seq = self.latest[2]
+            if seq != self.last_read_seq:
+                self.dropped += 1
+
+            self.frames += 1
+            self.latest = (frame, time.time(), seq + 1)
+
+        self.cap.release()
 
 
 class FTPCamera(BaseCamera):
@@ -414,44 +673,98 @@ class FTPCamera(BaseCamera):
         self.auth = DummyAuthorizer()
         self.auth.add_user(self.ftp_user, self.ftp_pass, os.getcwd(), perm='elradfmwMT')
 
-        self.img_buffer = queue.Queue(self.buffer_size)
+        # Newest uploads, the oldest is dropped when full
+        self.img_buffer = deque(maxlen=self.buffer_size)
+        self.received = 0
+        self.dropped = 0
+
+        class MemoryFS(AbstractedFS):
+            """Keep uploads in memory instead of writing them to disk"""
+            def __init__(fs_self, root, cmd_channel):
+                super().__init__(root, cmd_channel)
+                fs_self.uploads = {}
+
+            def open(fs_self, filename, mode):
+                if 'w' in mode or 'a' in mode:
+                    return _MemoryUpload(filename, fs_self.uploads)
+                return super().open(filename, mode)
 
         this = self
         class CamHandler(FTPHandler):
 
             def on_file_received(ftp_self, fn):
 
-                if not fn.endswith('.jpg'):
-                    return
+                img_data = ftp_self.fs.uploads.pop(fn, None)
 
-                with open(fn, 'rb') as img_file:
-                    this.img_buffer.put(img_file.read())
+                if img_data is None or not fn.endswith('.jpg'):
+                    return
 
-                os.remove(fn)
+                if len(this.img_buffer) == this.img_buffer.maxlen:
+                    this.dropped += 1
+                this.received += 1
+                this.img_buffer.append(img_data)
 
-            def on_incomplete_file_received(self, fn):
+            def on_incomplete_file_received(ftp_self, fn):
 
-                os.remove(fn)
+                ftp_self.fs.uploads.pop(fn, None)
 
         self.handler = CamHandler
         self.handler.authorizer = self.auth
+        self.handler.abstracted_fs = MemoryFS
 
         self.server = FTPServer((self.ftp_ip, self.ftp_port), self.handler)
-        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.running = True
+        self.server_thread = threading.Thread(target=self._serve)
         self.server_thread.daemon = True
         self.server_thread.start()
 
         logging.info('Found FTP Camera')
 
 
+    def close(self):
+        # Free the port so a reloaded camera can bind it
+        self.running = False
+        self.server_thread.join(5)
+
+
+    def _serve(self):
+        # pyftpdlib's loop isn't thread safe so it's stopped from its own thread
+        while self.running:
+            self.server.ioloop.loop(timeout=0.5, blocking=False)
+        self.server.close_all()
+
+
     def ready(self):
-        return not self.img_buffer.empty()
+        return len(self.img_buffer) > 0
+
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            'received': self.received,
+            'dropped': self.dropped
+        })
+        return stats
 
 
     def capture(self):
-        if not self.img_buffer.empty():
-            return self.img_buffer.get()
-        return None
+        try:
+            return self.img_buffer.popleft()
+        except IndexError:
+            return None
+
+
+class _MemoryUpload(io.BytesIO):
+    """A file uploaded to the FTP server that's saved to `uploads[name]` once closed"""
+    def __init__(self, name, uploads):
+        super().__init__()
+        self.name = name
+        self.uploads = uploads
+
+    def close(self):
+        if not self.closed:
+            self.uploads[self.name] = self.getvalue()
+        super().close()
 
 
 # Aliases for the cameras
@@ -465,18 +778,231 @@ CAMERAS = {
 }
 
 
-def is_broken(img):
-    """A very basic check to see if the img was corrupted"""
-    h, w = img.shape[:2]
+class Frame:
+
+    def __init__(self, array=None, jpeg=None, date=None):
+        """
+        A single capture as an image array and/or JPEG bytes.
+
+        The missing form and the SMALL_DIM version are computed on first use (at most once).
+        """
+        self.date = datetime.now() if date is None else date
+        self._array = array
+        self._jpeg = jpeg
+        self._small = None
+        self._decoded = array is not None
+        self._shape = None if array is None else array.shape
+
+
+    @property
+    def array(self):
+        if not self._decoded:
+            self._decoded = True
+            self._array = cv2.imdecode(np.frombuffer(self._jpeg, np.uint8), cv2.IMREAD_COLOR)
+            self._shape = None if self._array is None else self._array.shape
+        return self._array
+
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            return self.array.shape
+        return self._shape
+
+
+    @property
+    def small(self):
+        if self._small is None:
+            self._small = cv2.resize(self.array, SMALL_DIM)
+        return self._small
+
+
+    @property
+    def jpeg(self):
+        if self._jpeg is None:
+            _, img_data = cv2.imencode('.jpg', self._array)
+            self._jpeg = img_data.tobytes()
+        return self._jpeg
+
+
+    @property
+    def nbytes(self):
+        """Approx. memory used by the frame's image data"""
+        size = 0
+        if self._array is not None:
+            size += self._array.nbytes
+        if self._jpeg is not None:
+            size += len(self._jpeg)
+        if self._small is not None:
+            size += self._small.nbytes
+        return size
+
+
+    def compact(self):
+        """Keep only the JPEG, small version and shape (a full size array is ~6MB at 1080p), returns self"""
+        if self._decoded and self._array is not None:
+            self.jpeg
+            self.small
+            self._array = None
+            self._decoded = False
+        return self
+
+
+class BrokenDetector:
+
+    def __init__(self, stripes=True, columns=False, grey_rows=0, grey_range=4, frozen=0, truncated=True):
+        """
+        Detect corrupted frames using vectorized row/column stats.
+
+        stripes: flag repeated rows (smeared or duplicated scanlines)
+        columns: also flag repeated columns (can reject frames with black bars)
+        grey_rows: flag this many trailing flat rows (grey block), 0 to disable
+            (can reject frames with a dark foreground or an OSD strip)
+        grey_range: max pixel range within a row for it to count as flat
+        frozen: flag after this many identical frames in a row, 0 to disable
+        truncated: flag JPEG data missing its end-of-image marker
+        """
+        self.stripes = stripes
+        self.columns = columns
+        self.grey_rows = grey_rows
+        self.grey_range = grey_range
+        self.frozen = frozen
+        self.truncated = truncated
+
+        # state for frozen frame detection
+        self.last_sums = None
+        self.frozen_count = 0
+
+
+    def check_jpeg(self, img_data):
+        """Is the raw JPEG data corrupted"""
+        return self.truncated and is_truncated_jpeg(img_data)
+
+
+    def check(self, img):
+        """Is the img corrupted"""
+        h, w = img.shape[:2]
+        rows = img.reshape(h, -1)
+
+        # uint32 accumulators are much faster than int64 and can't overflow for uint8 imgs
+        row_sums = rows.sum(axis=1, dtype=np.uint32)
 
-    for i in range(0, h - 3, 3):
-        row1 = np.sum(img[i, :, :])
-        row2 = np.sum(img[i + 1, :, :])
-        row3 = np.sum(img[i + 2, :, :])
-        if row1 == row2 == row3:
+        if self.stripes and _has_repeats(row_sums):
             return True
 
-    return False
+        if self.columns or self.frozen > 0:
+            col_sums = rows.sum(axis=0, dtype=np.uint32).reshape(w, -1).sum(axis=1)
+
+        if self.columns and _has_repeats(col_sums):
+            return True
+
+        if self.grey_rows > 0 and h >= self.grey_rows:
+            tail = rows[-self.grey_rows:]
+            flat = tail.max(axis=1).astype(np.int16) - tail.min(axis=1) <= self.grey_range
+            if np.all(flat):
+                return True
+
+        if self.frozen > 0:
+            sums = np.concatenate((row_sums, col_sums))
+            if self.last_sums is not None and np.array_equal(sums, self.last_sums):
+                self.frozen_count += 1
+            else:
+                self.frozen_count = 0
+            self.last_sums = sums
+            if self.frozen_count >= self.frozen:
+                return True
+
+        return False
+
+
+def _has_repeats(sums):
+    """Check for 3 equal sums in a row (sampled every 3rd line)"""
+    a, b, c = sums[0:-3:3], sums[1:-2:3], sums[2:-1:3]
+    return bool(np.any((a == b) & (b == c)))
+
+
+def is_truncated_jpeg(img_data):
+    """Check that the JPEG data ends with an EOI marker (some cameras pad after it)"""
+    return b'\xff\xd9' not in img_data[-16:]
+
+
+class MotionScorer:
+
+    def __init__(self, scale=4, pre_ratio=0.5, ratio=10000, calibrate=20, full_every=30,
+                 min_ratio=500, max_ratio=50000):
+        """
+        Score motion in stages so SSIM/NRMSE only runs when a frame might have motion.
+
+        scale: downsample factor for the cheap grayscale frame delta
+        pre_ratio: fraction of the threshold the cheap estimate must reach to run the full score
+            (the gate is raised towards the threshold as the estimate gets more accurate)
+        ratio: initial full score / frame delta ratio, updated whenever the full score runs
+        calibrate: # of frames to always compute the full score for before gating
+        full_every: always compute the full score every this many frames to keep `ratio` calibrated
+        min_ratio, max_ratio: bounds for `ratio`
+        """
+        self.scale = scale
+        self.pre_ratio = pre_ratio
+        self.ratio = ratio
+        self.calibrate = calibrate
+        self.full_every = full_every
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+
+        # Relative error of the estimate vs the full score
+        self.error = 1.0
+        self.frames = 0
+
+        # Was the last score the full score (vs the estimate)
+        self.full = False
+
+        # Downsampled versions of the imgs still in use (the next prev frame or the camera's reference frames)
+        self.grays = {}
+
+
+    def score(self, prev_img, now_img, threshold=None):
+        """Calculate the motion between images on the `compute_motion_score` scale"""
+        delta = cv2.absdiff(self._gray(prev_img), self._gray(now_img)).mean() / 255
+
+        estimate = delta * self.ratio
+        self.frames += 1
+
+        sample = self.frames <= self.calibrate or self.frames % self.full_every == 0
+
+        if threshold is not None and not sample and estimate < threshold * self._gate():
+            self.full = False
+            return estimate
+
+        score = compute_motion_score(prev_img, now_img)
+        self.full = True
+
+        # Keep the cheap estimate calibrated to the full score
+        if delta > 1e-3:
+            # Learn quickly while calibrating
+            alpha = max(0.1, 1 / self.frames)
+            self.error = (1 - alpha) * self.error + alpha * min(1.0, abs(score - estimate) / max(score, 1e-6))
+            ratio = (1 - alpha) * self.ratio + alpha * score / delta
+            self.ratio = min(max(ratio, self.min_ratio), self.max_ratio)
+
+        return score
+
+
+    def _gate(self):
+        """The fraction of the threshold the estimate must reach to run the full score"""
+        return max(self.pre_ratio, 1 / (1 + 3 * self.error))
+
+
+    def _gray(self, img):
+        key = id(img)
+        if key in self.grays:
+            return self.grays[key][1]
+        h, w = img.shape[:2]
+        small = cv2.resize(img, (max(1, w // self.scale), max(1, h // self.scale)), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        # Forget it once the img is garbage collected (its id can then be reused)
+        ref = weakref.ref(img, lambda _, key=key, grays=self.grays: grays.pop(key, None))
+        self.grays[key] = (ref, gray)
+        return gray
 
 
 def compute_motion_score(prev_img, now_img):
@@ -494,8 +1020,292 @@ def compute_motion_score(prev_img, now_img):
     return score
 
 
+class MotionThreshold:
+
+    def __init__(self, alpha=0.01, k=10, warmup=50, relearn=300):
+        """
+        An 'auto' motion threshold from the exponentially weighted mean/std of motion scores.
+
+        alpha: weight of each new score (~1/alpha frames of memory)
+        k: # of stds above the mean to count as motion
+        warmup: # of scores to collect before the threshold is used
+        relearn: # of scores in a row above the threshold before the scene is considered
+            changed (ex. lights turned on) and the threshold is recalibrated
+        """
+        self.alpha = alpha
+        self.k = k
+        self.warmup = warmup
+        self.relearn = relearn
+        self.count = 0
+        self.mean = 0
+        self.var = 0
+        self.above = 0
+
+
+    @property
+    def ready(self):
+        return self.count >= self.warmup
+
+
+    @property
+    def threshold(self):
+        if not self.ready:
+            return 1e9
+        return self.mean + self.k * self.var ** 0.5
+
+
+    def update(self, motion):
+        """Add a motion score, returns the new threshold"""
+        # Motion shouldn't raise the threshold, unless it never ends
+        if self.ready and motion > self.threshold:
+            self.above += 1
+            if self.above < self.relearn:
+                return self.threshold
+            logging.info('Motion stayed above {}, recalibrating'.format(self.threshold))
+            self.count = 0
+
+        self.above = 0
+        self.count += 1
+
+        # Plain average while warming up
+        alpha = max(self.alpha, 1 / self.count)
+
+        diff = motion - self.mean
+        self.mean += alpha * diff
+        self.var = (1 - alpha) * (self.var + alpha * diff * diff)
+
+        return self.threshold
+
+
+class MotionRegion:
+
+    def __init__(self, roi=None, exclude=None, shape=SMALL_DIM):
+        """
+        Limit motion detection to part of the frame.
+
+        roi: list of polygons ([[x, y], ...] with coords from 0-1) to watch, defaults to the whole frame
+        exclude: list of polygons to ignore
+        shape: the (w, h) of the frames motion is computed on
+        """
+        w, h = shape
+        self.mask = np.zeros((h, w), np.uint8)
+
+        if roi:
+            cv2.fillPoly(self.mask, self._to_pixels(roi, w, h), 255)
+        else:
+            self.mask[:] = 255
+
+        if exclude:
+            cv2.fillPoly(self.mask, self._to_pixels(exclude, w, h), 0)
+
+        # Crop to the mask's bounding box so only relevant pixels are compared
+        ys, xs = np.nonzero(self.mask)
+        if len(ys) == 0:
+            raise ValueError('Camera ROI is empty')
+        self.crop = (slice(ys.min(), ys.max() + 1), slice(xs.min(), xs.max() + 1))
+        self.crop_mask = self.mask[self.crop]
+
+        # Skip masking if the crop is all relevant
+        if self.crop_mask.all():
+            self.crop_mask = None
+
+
+    def apply(self, img):
+        """Crop the frame and blank excluded pixels"""
+        img = img[self.crop]
+        if self.crop_mask is not None:
+            img = cv2.bitwise_and(img, img, mask=self.crop_mask)
+        return img
+
+
+    def contains(self, bbox, shape):
+        """Is the center of `bbox` (in a frame of `shape`) inside the region"""
+        h, w = shape[:2]
+        mask_h, mask_w = self.mask.shape
+        x = int((bbox[0] + bbox[2]) / 2 / w * mask_w)
+        y = int((bbox[1] + bbox[3]) / 2 / h * mask_h)
+        x = min(max(x, 0), mask_w - 1)
+        y = min(max(y, 0), mask_h - 1)
+        return self.mask[y, x] > 0
+
+
+    def _to_pixels(self, polygons, w, h):
+        return [(np.array(polygon, np.float32) * (w, h)).astype(np.int32) for polygon in polygons]
+
+
+class PreRollBuffer:
+
+    def __init__(self, frames=8, slot_kb=512):
+        """
+        A ring buffer of the last `frames` JPEGs in preallocated `slot_kb` slots.
+
+        Frames bigger than a slot are skipped.
+        """
+        self.frames = frames
+        self.slot_bytes = slot_kb * 1024
+        self.buffer = memoryview(bytearray(frames * self.slot_bytes))
+        self.sizes = [0] * frames
+        self.dates = [None] * frames
+        self.motions = [0] * frames
+        self.next = 0
+        self.count = 0
+
+
+    def push(self, date, image_data, motion=0):
+        """Store a JPEG (anything supporting the buffer protocol) overwriting the oldest"""
+        size = len(image_data)
+        if size > self.slot_bytes:
+            logging.warning('Pre-roll frame too big ({} bytes), increase pre_roll_kb'.format(size))
+            return False
+
+        start = self.next * self.slot_bytes
+        self.buffer[start:start + size] = image_data
+        self.sizes[self.next] = size
+        self.dates[self.next] = date
+        self.motions[self.next] = motion
+
+        self.next = (self.next + 1) % self.frames
+        self.count = min(self.count + 1, self.frames)
+        return True
+
+
+    def pop_all(self):
+        """Copy out all frames as (date, jpeg bytes, motion) oldest first and empty the buffer"""
+        frames = []
+        for i in range(self.next - self.count, self.next):
+            i %= self.frames
+            start = i * self.slot_bytes
+            frames.append((self.dates[i], bytes(self.buffer[start:start + self.sizes[i]]), self.motions[i]))
+        self.count = 0
+        return frames
+
+
+class AdaptiveRate:
+    """
+    Picks how often a monitoring camera should capture.
+
+    Ticks every `min_tick` secs during events or when motion is within `near` of the threshold,
+    otherwise backs off by `backoff` each tick up to `max_tick` secs.
+    """
+    def __init__(self, min_tick=0.2, max_tick=4.0, backoff=1.5, near=0.5):
+        self.min_tick = min_tick
+        self.max_tick = max_tick
+        self.backoff = backoff
+        self.near = near
+        self.interval = min_tick
+
+    def update(self, motion, threshold, active=False):
+        if active or motion >= threshold * self.near:
+            self.interval = self.min_tick
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_tick)
+        return self.interval
+
+
+class DetectionWorker:
+
+    def __init__(self, max_pending=4, max_pending_mb=64):
+        """
+        Label events on a background thread so object detection doesn't block ticks.
+
+        max_pending: max # of events waiting to be labeled, once full
+            new events are labeled without object detection
+        max_pending_mb: max MB of frames waiting to be labeled (also labeled w/o detection once full)
+        """
+        self.pending = queue.Queue(max_pending)
+        self.finished = queue.Queue()
+        self.max_pending_bytes = max_pending_mb * 1024 * 1024
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def submit(self, event, event_images, batch_size=16, region=None):
+        """Queue an event to be labeled, returns False if the queue is full"""
+        # Only keep what labeling needs while it waits
+        event_images = [(frame.compact(), motion) for frame, motion in event_images]
+        size = sum(frame.nbytes for frame, _ in event_images)
+        with self.lock:
+            try:
+                if self.pending_bytes + size > self.max_pending_bytes:
+                    raise queue.Full()
+                self.pending.put_nowait((event, event_images, batch_size, region, size))
+                self.pending_bytes += size
+                return True
+            except queue.Full:
+                logging.warning('Detection queue full, skipping object detection for {}'.format(event))
+                return False
+
+
+    def get_finished(self):
+        """Get all the events that are done being labeled"""
+        done = []
+        while not self.finished.empty():
+            done.append(self.finished.get())
+        return done
+
+
+    def _run(self):
+        while True:
+            event, event_images, batch_size, region, size = self.pending.get()
+            try:
+                label_event_safe(event, event_images, batch_size=batch_size, region=region)
+                logging.info('Labeled Event {}'.format(event))
+                self.finished.put(event)
+            except Exception as e:
+                logging.error('Failed to label event {}: {}'.format(event, e))
+            finally:
+                with self.lock:
+                    self.pending_bytes -= size
+
+
+def label_event(event, event_images, use_ai=True, batch_size=16, region=None):
+    """Add captured (frame, motion) to `event` with detected objects (inside `region`) and score it"""
+    if use_ai:
+        all_detected = detect_objs_batch([frame.small for frame, _ in event_images],
+                                         output_shapes=[frame.shape for frame, _ in event_images],
+                                         batch_size=batch_size)
+    else:
+        all_detected = [[] for _ in event_images]
+
+    if region is not None:
+        all_detected = [[obj for obj in detected if region.contains(obj.bbox, frame.shape)]
+                        for (frame, _), detected in zip(event_images, all_detected)]
+
+    # Frames are only JPEG encoded if they weren't captured as JPEGs (or already encoded for a snapshot)
+    for (frame, motion), detected in zip(event_images, all_detected):
+        event.add_image_data(frame.jpeg, date=frame.date, objects=detected, motion=motion)
+
+    # Compute the event's score
+    events.score(event)
+
+    return event
+
+
+def label_event_safe(event, event_images, use_ai=True, batch_size=16, region=None):
+    """Like `label_event` but if object detection fails the images are added w/o objects"""
+    num_images = len(event.images)
+    try:
+        return label_event(event, event_images, use_ai, batch_size, region)
+    except Exception as e:
+        if not use_ai:
+            raise
+        logging.error('Failed to detect objects in {}: {}'.format(event, e))
+        del event.images[num_images:]
+        return label_event(event, event_images, use_ai=False)
+
+
 def detect_objs(image, min_confid=0.6, objects=None, output_shape=None):
     """Detect objects in the image"""
+    output_shapes = None if output_shape is None else [output_shape]
+    return detect_objs_batch([image], min_confid=min_confid, objects=objects, output_shapes=output_shapes)[0]
+
+
+def detect_objs_batch(images, min_confid=0.6, objects=None, output_shapes=None, batch_size=16):
+    """Detect objects in a list of images using batched forward passes"""
     all_classes = [
         "background", "aeroplane", "bicycle", "bird", "boat",
         "bottle", "bus", "car", "cat", "chair", "cow", "diningtable",
@@ -507,34 +1317,44 @@ def detect_objs(image, min_confid=0.6, objects=None, output_shape=None):
     if objects is None:
         objects = ['bus', 'motorbike', 'car', 'cat', 'cow', 'person', 'horse', 'bird', 'sheep']
 
-    # The original image's shape to calc true bounding box
-    if output_shape is None:
-        output_shape = image.shape
+    # The original images' shapes to calc true bounding boxes
+    if output_shapes is None:
+        output_shapes = [image.shape for image in images]
+
+    detected = [[] for _ in images]
+
+    for start in range(0, len(images), batch_size):
+
+        batch = images[start:start + batch_size]
 
-    (h, w) = output_shape[:2]
+        blob = cv2.dnn.blobFromImages(batch, 0.007843, SMALL_DIM, 127.5)
 
-    blob = cv2.dnn.blobFromImage(image, 0.007843, SMALL_DIM, 127.5)
+        with mobile_net_lock:
+            mobile_net.setInput(blob)
+            detections = mobile_net.forward()
 
-    mobile_net.setInput(blob)
-    detections = mobile_net.forward()
+        # Each detection is [batch idx, class idx, confidence, x1, y1, x2, y2]
+        for i in np.arange(0, detections.shape[2]):
 
-    detected = []
+            confid = detections[0, 0, i, 2]
+            class_idx = int(detections[0, 0, i, 1])
+            image_idx = int(detections[0, 0, i, 0])
 
-    for i in np.arange(0, detections.shape[2]):
+            # Check that this is a valid idx (sometimes it's not...)
+            if 0 > class_idx or class_idx >= len(all_classes):
+                continue
 
-        confid = detections[0, 0, i, 2]
-        class_idx = int(detections[0, 0, i, 1])
+            if 0 > image_idx or image_idx >= len(batch):
+                continue
 
-        # Check that this is a valid idx (sometimes it's not...)
-        if 0 > class_idx or class_idx >= len(all_classes):
-            continue
+            obj_name = all_classes[class_idx]
 
-        obj_name = all_classes[class_idx]
+            if confid > min_confid and obj_name in objects:
 
-        if confid > min_confid and obj_name in objects:
+                (h, w) = output_shapes[start + image_idx][:2]
 
-            bbox = (detections[0, 0, i, 3:7] * np.array([w, h, w, h])).astype("int")
+                bbox = (detections[0, 0, i, 3:7] * np.array([w, h, w, h])).astype("int")
 
-            detected.append(events.EventObject(obj_name, bbox=bbox))
+                detected[start + image_idx].append(events.EventObject(obj_name, bbox=bbox))
 
     return detected
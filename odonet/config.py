@@ -27,6 +27,25 @@ def is_same_config(a, b):
     return repr(a) == repr(b)
 
 
+def check_regions(config):
+    """Check the `roi`/`exclude` polygons of a config's devices, returns an error msg or None"""
+    for device_conf in config.get('devices', []):
+        for key in ['roi', 'exclude']:
+            polygons = device_conf.get(key)
+            if polygons is None:
+                continue
+            try:
+                for polygon in polygons:
+                    if len(polygon) < 3:
+                        return '`{}` polygons need at least 3 points'.format(key)
+                    for x, y in polygon:
+                        if not (0 <= x <= 1 and 0 <= y <= 1):
+                            return '`{}` points should be from 0 to 1'.format(key)
+            except (TypeError, ValueError):
+                return '`{}` should be a list of [[x, y], ...] polygons'.format(key)
+    return None
+
+
 def copy(config):
     """Clone the config"""
     return eval(repr(config))
@@ -1,6 +1,11 @@
 """
 Devices
 """
+import threading
+import logging
+import time
+
+
 class Device:
     """A the base device object"""
     def __init__(self):
@@ -9,9 +14,86 @@ class Device:
     def tick(self):
         return TickResult()
 
+    def close(self):
+        """Release anything the device is holding once it stops ticking"""
+        pass
+
+    def stats(self):
+        """Device specific stats to report with the tick times"""
+        return {}
+
+    def next_tick_length(self, tick_length):
+        """How long until the next tick (devices can override to change their rate)"""
+        return tick_length
+
 
 class TickResult:
     """An object to store the results of a device tick"""
     def __init__(self):
         self.image = None
         self.event = None
+
+
+class DeviceLoop:
+    """Tick a device on its own thread and put results in a shared queue"""
+    def __init__(self, idx, device, tick_length, results):
+        self.idx = idx
+        self.device = device
+        self.tick_length = tick_length
+        self.results = results
+
+        # Tick latency stats (seconds)
+        self.last_tick_time = 0
+        self.avg_tick_time = 0
+        self.max_tick_time = 0
+        self.interval = tick_length
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.device.close()
+
+    def stats(self):
+        stats = {
+            'last': round(self.last_tick_time, 3),
+            'avg': round(self.avg_tick_time, 3),
+            'max': round(self.max_tick_time, 3),
+            'interval': round(self.interval, 3)
+        }
+        stats.update(self.device.stats())
+        return stats
+
+    def _run(self):
+        while self.running:
+
+            start = time.time()
+
+            try:
+                tick_result = self.device.tick()
+            except Exception as e:
+                logging.error('Device {} tick failed: {}'.format(self.idx, e))
+                tick_result = None
+
+            tick_time = time.time() - start
+            self.last_tick_time = tick_time
+            self.avg_tick_time = 0.9 * self.avg_tick_time + 0.1 * tick_time
+            self.max_tick_time = max(self.max_tick_time, tick_time)
+
+            if tick_time > self.tick_length:
+                logging.warning('Device {} tick took {:.2f}s'.format(self.idx, tick_time))
+
+            # Blocks if the node can't send results fast enough
+            if tick_result is not None and (tick_result.image is not None or tick_result.event is not None):
+                self.results.put((self.idx, tick_result))
+
+            # Make sure the device isnt ticking too fast
+            self.interval = self.device.next_tick_length(self.tick_length)
+            time.sleep(max(0, self.interval - time.time() + start))
@@ -1,9 +1,17 @@
 
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
 import subprocess
+import threading
 import tempfile
 import logging
+import sqlite3
 import pickle
+import struct
+import json
+import time
 import os
 
 
@@ -19,15 +27,66 @@ except ImportError:
     logging.warning('Numpy not found.')
     logging.info('$ pip install numpy')
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+    logging.warning('Pillow not found, ImageMagick will be used for gifs.')
+    logging.info('$ pip install pillow')
+
 
 TIME_FORMAT = '%Y-%m-%d-%H-%M-%S'
 
 THUMB_SIZE = (300, 170)
 
+PREVIEW_SIZE = (300, 170)
+
+# Gifs are rendered in the background by a few workers,
+# `save_event` waits once this many are queued/rendering
+RENDER_WORKERS = 2
+RENDER_MAX_PENDING = 8
+
 CUR_DIR = os.path.dirname(__file__)
 
 EVENTS_PATH = os.path.join(CUR_DIR, '..', 'events')
 
+INDEX_FN = os.path.join(EVENTS_PATH, 'index.db')
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    name TEXT PRIMARY KEY,
+    node TEXT,
+    date TEXT,
+    score INTEGER,
+    length INTEGER,
+    size INTEGER,
+    ext TEXT
+);
+CREATE INDEX IF NOT EXISTS events_date ON events (date);
+CREATE INDEX IF NOT EXISTS events_node_date ON events (node, date);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER
+);
+INSERT OR IGNORE INTO totals VALUES (0, 0);
+"""
+
+_index_lock = threading.RLock()
+
+_render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS)
+_render_slots = threading.BoundedSemaphore(RENDER_MAX_PENDING)
+
+# mkstemp files are 0600, give rendered files the usual permissions
+# (the umask is read once here since reading it isn't thread safe)
+_umask = os.umask(0)
+os.umask(_umask)
+_FILE_MODE = 0o666 & ~_umask
+
+# [Magic 4 bytes][Version 2 bytes][Meta size 4 bytes][Meta JSON ? bytes][JPEG frames ? bytes]
+EVENT_MAGIC = b'ODOE'
+EVENT_VERSION = 1
+EVENT_HEADER = struct.Struct('!4sHI')
+
 
 class Event:
 
@@ -53,6 +112,17 @@ class Event:
         self.images.append((date, image_data, motion, objects))
 
 
+    def add_image_data(self, image_data, objects=None, date=None, motion=0):
+        """Like `add_image` but with already JPEG encoded bytes"""
+        if date is None:
+            date = datetime.now()
+
+        if objects is None:
+            objects = []
+
+        self.images.append((date, image_data, motion, objects))
+
+
     @property
     def age(self):
         return (datetime.now() - self.init_date).seconds
@@ -95,7 +165,121 @@ def score(event):
     return score
 
 
-def save_event(event, thumb=True, gif=True):
+def encode_event(event):
+    """Serialize an event as metadata followed by the raw JPEG frames"""
+    frames = []
+    offset = 0
+
+    for date, image_data, motion, objects in event.images:
+        frames.append({
+            'date': date.isoformat(),
+            'motion': float(motion),
+            'objects': [{'name': obj.name, 'bbox': None if obj.bbox is None else [int(v) for v in obj.bbox]} for obj in objects],
+            'offset': offset,
+            'size': len(image_data)
+        })
+        offset += len(image_data)
+
+    meta = json.dumps({
+        'init_date': event.init_date.isoformat(),
+        'node': event.node,
+        'score': event.score,
+        'frames': frames
+    }).encode('utf-8')
+
+    header = EVENT_HEADER.pack(EVENT_MAGIC, EVENT_VERSION, len(meta))
+
+    return b''.join([header, meta] + [image_data for _, image_data, _, _ in event.images])
+
+
+def decode_event(data):
+    """Read an event serialized by `encode_event`, frames are views of `data`"""
+    view = memoryview(data)
+    meta, frames_start = _decode_event_meta(view)
+
+    event = Event()
+    event.init_date = datetime.fromisoformat(meta['init_date'])
+    event.node = meta['node']
+    event.score = meta['score']
+
+    for frame in meta['frames']:
+        start = frames_start + frame['offset']
+        date, motion, objects = _decode_frame_meta(frame)
+        event.images.append((date, view[start:start + frame['size']], motion, objects))
+
+    return event
+
+
+def _decode_frame_meta(frame):
+    objects = [EventObject(obj['name'], bbox=None if obj['bbox'] is None else np.array(obj['bbox']))
+               for obj in frame['objects']]
+    return datetime.fromisoformat(frame['date']), frame['motion'], objects
+
+
+class EventFile:
+
+    def __init__(self, fn):
+        """
+        A saved event that only reads its metadata from disk,
+        frames are read one at a time with `read_frame`.
+        """
+        self.fn = fn
+
+        with open(fn, 'rb') as event_file:
+            meta, self.frames_start = read_event_meta(event_file)
+
+        self.init_date = datetime.fromisoformat(meta['init_date'])
+        self.node = meta['node']
+        self.score = meta['score']
+        self.frames = meta['frames']
+
+        # Same layout as `Event.images` but without the image data
+        self.images = []
+        for frame in self.frames:
+            date, motion, objects = _decode_frame_meta(frame)
+            self.images.append((date, None, motion, objects))
+
+
+    def read_frame(self, idx):
+        """Read the JPEG data of frame `idx`"""
+        frame = self.frames[idx]
+        with open(self.fn, 'rb') as event_file:
+            event_file.seek(self.frames_start + frame['offset'])
+            return event_file.read(frame['size'])
+
+
+    def __len__(self):
+        return len(self.frames)
+
+
+    def __str__(self):
+        return '<EventFile images={} node={} time=({})>'.format(len(self.frames), self.node, self.init_date)
+
+
+def read_event_meta(event_file):
+    """Read just the metadata of a serialized event, returns the meta and where the frames start"""
+    header = event_file.read(EVENT_HEADER.size)
+    magic, version, meta_size = _check_event_header(header)
+    meta = json.loads(event_file.read(meta_size).decode('utf-8'))
+    return meta, EVENT_HEADER.size + meta_size
+
+
+def _decode_event_meta(view):
+    magic, version, meta_size = _check_event_header(view)
+    meta = json.loads(bytes(view[EVENT_HEADER.size:EVENT_HEADER.size + meta_size]).decode('utf-8'))
+    return meta, EVENT_HEADER.size + meta_size
+
+
+def _check_event_header(header):
+    magic, version, meta_size = EVENT_HEADER.unpack_from(header)
+    if magic != EVENT_MAGIC:
+        raise ValueError('Not an event')
+    if version > EVENT_VERSION:
+        raise ValueError('Unsupported event version {}'.format(version))
+    return magic, version, meta_size
+
+
+def save_event(event, thumb=True, gif=True, preview=False):
 
     dir = os.path.join(EVENTS_PATH, event.node)
     os.makedirs(dir, exist_ok=True)
@@ -104,82 +288,308 @@ def save_event(event, thumb=True, gif=True):
     name = '{}_{}_{}_{}'.format(date_formatted, event.node, int(event.score), len(event))
     fn = os.path.join(dir, name)
 
-    with open(fn + '.event.pkl', 'wb') as event_file:
-        pickle.dump(event, event_file)
+    with open(fn + '.event.bin', 'wb') as event_file:
+        event_file.write(encode_event(event))
 
-    if thumb and len(event.images) > 0:
-        _create_thumb(event, fn + '.event.jpg')
+    _index_event(name + '.event', '.bin', os.path.getsize(fn + '.event.bin'))
 
-    if gif and len(event.images) > 0:
-        _create_gif(event, fn + '.event.gif')
+    if (thumb or gif or preview) and len(event.images) > 0:
+        _render_slots.acquire()
+        _render_pool.submit(_process_event, event, fn, thumb, gif, preview)
 
 
-def _create_thumb(event, output_name):
-    img_data = max(event.images, key=lambda i: i[2])[1]
-    img_data = np.fromstring(img_data, np.uint8)
-    img = cv2.imdecode(img_data, cv2.IMREAD_COLOR)
-    img = cv2.resize(img, THUMB_SIZE)
-    cv2.imwrite(output_name, img)
+def _process_event(event, fn, thumb=True, gif=True, preview=False):
+    """Create the thumbnail/gifs of an event decoding each frame once (runs on the render pool)"""
+    try:
+        timings = []
+        start = time.time()
+
+        # Only the full gif needs full sized frames
+        if gif:
+            min_size = None
+        else:
+            min_size = (max(THUMB_SIZE[0], PREVIEW_SIZE[0]), max(THUMB_SIZE[1], PREVIEW_SIZE[1]))
 
+        frames = _decode_frames(event, min_size)
+        start = _time_stage(timings, 'decode', start)
 
-def _create_gif(event, output_name, frame_delay=60):
+        if thumb:
+            idx = max(range(len(event.images)), key=lambda i: event.images[i][2])
+            _create_thumb(frames[idx], fn + '.event.jpg')
+            start = _time_stage(timings, 'thumb', start)
+
+        if gif:
+            _create_gif(frames, fn + '.event.gif')
+            start = _time_stage(timings, 'gif', start)
+
+        if preview:
+            _create_gif([cv2.resize(frame, PREVIEW_SIZE, interpolation=cv2.INTER_AREA) for frame in frames],
+                        fn + '.event.preview.gif')
+            start = _time_stage(timings, 'preview', start)
+
+        logging.info('Processed {} ({})'.format(event, ', '.join('{} {:.3f}s'.format(*t) for t in timings)))
+
+    except Exception as e:
+        logging.error('Failed to process {}: {}'.format(event, e))
+
+    finally:
+        _render_slots.release()
+
+
+def _time_stage(timings, stage, start):
+    now = time.time()
+    timings.append((stage, now - start))
+    return now
+
+
+def _create_thumb(frame, output_name):
+    img = cv2.resize(frame, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+    _, data = cv2.imencode('.jpg', img)
+    _write_atomic(output_name, data.tobytes())
+
+
+def _decode_frames(event, min_size=None):
+    """
+    Decode the event's JPEG frames.
+
+    If `min_size` is given frames are decoded at a reduced scale (faster) but still at least that big.
+    """
+    frames = []
+
+    for date, image_data, motion, objects in event.images:
+        flag = cv2.IMREAD_COLOR
+        if min_size is not None:
+            flag = _reduced_flag(_jpeg_size(image_data), min_size)
+        frames.append(cv2.imdecode(np.frombuffer(image_data, np.uint8), flag))
+
+    return frames
+
+
+def _reduced_flag(size, min_size):
+    """Pick the smallest JPEG decode scale that's at least `min_size`"""
+    if size is None:
+        return cv2.IMREAD_COLOR
+    w, h = size
+    for scale, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if w // scale >= min_size[0] and h // scale >= min_size[1]:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def _jpeg_size(data):
+    """Read the (width, height) from the JPEG's frame header without decoding it"""
+    data = memoryview(data)
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        length = struct.unpack_from('>H', data, i + 2)[0]
+        # SOF markers (besides DHT, JPG, and DAC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack_from('>HH', data, i + 5)
+            return w, h
+        i += 2 + length
+    return None
+
+
+def _write_atomic(output_name, data):
+    """Write the file so that it only appears once it's complete"""
+    tmp_fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(output_name))
+    try:
+        with os.fdopen(tmp_fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.chmod(tmp_name, _FILE_MODE)
+        os.replace(tmp_name, output_name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+def _create_gif(frames, output_name, frame_delay=60):
+    """Write BGR `frames` as a gif (`frame_delay` in 1/100 secs), the file only appears once it's complete"""
+    tmp_fd, tmp_name = tempfile.mkstemp(suffix='.gif', dir=os.path.dirname(output_name))
+    os.close(tmp_fd)
+
+    try:
+        if Image is not None:
+            images = [Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)) for frame in frames]
+            images[0].save(tmp_name, format='GIF', save_all=True, append_images=images[1:],
+                           duration=frame_delay * 10, loop=0)
+        else:
+            _create_gif_magick(frames, tmp_name, frame_delay)
+        os.chmod(tmp_name, _FILE_MODE)
+        os.replace(tmp_name, output_name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+def _create_gif_magick(frames, output_name, frame_delay):
+    """Fallback to ImageMagick when Pillow isn't installed"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        cmd = ['magick', 'convert', '-loop', '0']
+        for i, frame in enumerate(frames):
+            fn = os.path.join(tmp_dir, '{}.jpg'.format(i))
+            cv2.imwrite(fn, frame)
+            cmd.extend(['-delay', str(frame_delay), fn])
+        cmd += [output_name]
+
+        subprocess.run(cmd, check=True)
 
-    tmp_dir = tempfile.gettempdir()
-    tmp_fns = []
 
-    for i, (date, image_data, motion, objects) in enumerate(event.images):
-        fn = os.path.join(tmp_dir, 'tmp_gif_{}.jpg'.format(i))
-        tmp_fns.append(fn)
-        with open(fn, 'wb') as f:
-            f.write(image_data)
+def load_event(event_name):
 
-    cmd = ['magick', 'convert', '-delay', '10', '-loop', '0']
-    for tmp_fn in tmp_fns:
-        cmd.extend(['-delay', str(frame_delay), tmp_fn])
-    cmd += [output_name]
+    day, node, score, length = event_name.split('_')
 
-    subprocess.Popen(cmd)
+    base_fn = os.path.join(EVENTS_PATH, node, event_name)
 
+    # Events saved before the binary format are pickles
+    if not os.path.exists(base_fn + '.bin'):
+        with open(base_fn + '.pkl', 'rb') as event_file:
+            return base_fn, pickle.load(event_file)
+
+    with open(base_fn + '.bin', 'rb') as event_file:
+        return base_fn, decode_event(event_file.read())
 
-def load_event(event_name):
 
+def open_event(event_name):
+    """Like `load_event` but returns an `EventFile` (if it's not an old pickled event)"""
     day, node, score, length = event_name.split('_')
 
     base_fn = os.path.join(EVENTS_PATH, node, event_name)
 
-    with open(base_fn + '.pkl', 'rb') as event_file:
-        return base_fn, pickle.load(event_file)
+    if not os.path.exists(base_fn + '.bin'):
+        return load_event(event_name)
+
+    # Keyed on the file's stats too so a rewritten event (re-sent or rebuilt) isn't served stale
+    stat = os.stat(base_fn + '.bin')
+    return base_fn, _open_event_file(base_fn + '.bin', (stat.st_ino, stat.st_size, stat.st_mtime_ns))
+
 
+@lru_cache(maxsize=32)
+def _open_event_file(fn, stat_key):
+    return EventFile(fn)
 
-def load_events(limit=1000):
+
+def load_events(limit=1000, offset=0, node=None, start=None, end=None, min_score=None):
+    """
+    Query the event index, newest first.
+
+    Returns the total size of all events and a list of (date, node, score, base_fn, event_name)
+    """
+    where, args = _index_filters(node, start, end, min_score)
+
+    with _index() as db:
+        events_size = db.execute('SELECT size FROM totals').fetchone()[0]
+        rows = db.execute('SELECT date, node, score, name FROM events' + where +
+                          ' ORDER BY date DESC, name DESC LIMIT ? OFFSET ?', args + [limit, offset]).fetchall()
 
     events = []
-    events_size = 0
 
-    for node in os.listdir(EVENTS_PATH):
+    for day, id, score, event_name in rows:
+        date = datetime.strptime(day, TIME_FORMAT)
+        base_fn = os.path.join(EVENTS_PATH, id, event_name)
+        events.append((date, id, score, base_fn, event_name))
 
-        if len(node) != 1:
-            continue
+    return events_size, events
 
-        dir = os.path.join(EVENTS_PATH, node)
 
-        for fn in os.listdir(dir):
+def count_events(node=None, start=None, end=None, min_score=None):
+    """Count the events in the index"""
+    where, args = _index_filters(node, start, end, min_score)
+    with _index() as db:
+        return db.execute('SELECT COUNT(*) FROM events' + where, args).fetchone()[0]
 
-            if not fn.endswith('.pkl'):
-                continue
 
-            day, id, score, length = fn.split('_')
-            event_name = fn.replace('.pkl', '')
+def rebuild_index():
+    """Rebuild the event index from the events on disk"""
+    with _index_lock:
+        db = _connect_index()
+        try:
+            with db:
+                db.execute('DELETE FROM events')
+                db.execute('UPDATE totals SET size = 0')
+                for event_name, ext, size in _scan_events():
+                    _insert_event(db, event_name, ext, size)
+        finally:
+            db.close()
 
-            date = datetime.strptime(day, TIME_FORMAT)
 
-            base_fn = os.path.join(EVENTS_PATH, node, event_name)
+def _scan_events():
+    """Find all the saved events on disk"""
+    for node in os.listdir(EVENTS_PATH):
 
-            events_size += os.path.getsize(base_fn + '.pkl')
+        if len(node) != 1:
+            continue
 
-            events.append((date, id, score, base_fn, event_name))
+        dir = os.path.join(EVENTS_PATH, node)
 
-    events.sort(reverse=True)
-    events = events[:limit]
+        for fn in os.listdir(dir):
 
-    return events_size, events
+            if fn.endswith('.bin'):
+                ext = '.bin'
+            elif fn.endswith('.pkl'):
+                ext = '.pkl'
+            else:
+                continue
+
+            event_name = fn.replace(ext, '')
+
+            yield event_name, ext, os.path.getsize(os.path.join(dir, fn))
+
+
+def _index_event(event_name, ext, size):
+    with _index() as db:
+        _insert_event(db, event_name, ext, size)
+
+
+def _insert_event(db, event_name, ext, size):
+    day, id, score, length = event_name.split('_')
+    old = db.execute('SELECT size FROM events WHERE name = ?', (event_name,)).fetchone()
+    db.execute('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?)',
+               (event_name, id, day, int(score), int(length.split('.')[0]), size, ext))
+    db.execute('UPDATE totals SET size = size + ?', (size - (old[0] if old else 0),))
+
+
+def _index_filters(node, start, end, min_score):
+    filters, args = [], []
+    if node is not None:
+        filters.append('node = ?')
+        args.append(node)
+    if start is not None:
+        filters.append('date >= ?')
+        args.append(start.strftime(TIME_FORMAT))
+    if end is not None:
+        filters.append('date < ?')
+        args.append(end.strftime(TIME_FORMAT))
+    if min_score is not None:
+        filters.append('score >= ?')
+        args.append(min_score)
+    if len(filters) == 0:
+        return '', args
+    return ' WHERE ' + ' AND '.join(filters), args
+
+
+def _connect_index():
+    os.makedirs(EVENTS_PATH, exist_ok=True)
+    db = sqlite3.connect(INDEX_FN, timeout=30)
+    db.executescript(INDEX_SCHEMA)
+    return db
+
+
+@contextmanager
+def _index():
+    """Open the event index in a transaction, building it from disk the first time"""
+    with _index_lock:
+        if not os.path.exists(INDEX_FN):
+            logging.info('Building event index...')
+            rebuild_index()
+
+    db = _connect_index()
+    try:
+        with db:
+            yield db
+    finally:
+        db.close()
@@ -2,7 +2,9 @@
 Networking Utilities
 """
 from contextlib import contextmanager
+from collections import defaultdict
 import socketserver
+import select
 import threading
 import logging
 import socket
@@ -10,10 +12,13 @@ import struct
 
 from enum import Enum
 import pickle
+import queue
 import time
 import json
 import io
 
+from odonet import events
+
 
 class DataType(Enum):
     """Packet Types"""
@@ -21,11 +26,22 @@ class DataType(Enum):
     IMAGE = 2
     JSON = 3
     PICKLE = 4
+    POLL = 5
+    EVENT = 6
+
+
+# Sent at the start of a connection to use length-prefixed frames,
+# this can't be confused with a packet since addresses are ascii
+FRAME_MAGIC = b'\x00ODO'
+
+# [Size 4 bytes][Packet ? bytes]
+FRAME_HEADER = struct.Struct('!I')
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """A special TCP server that supports threading"""
-    pass
+    # Persistent connections shouldn't keep the server from closing
+    daemon_threads = True
 
 
 @contextmanager
@@ -83,27 +99,57 @@ def construct_packet(address, data_type, msg):
 
 def read_encoded_socket(sock, reader_id='', decode_iif_mine=False):
     """Read a packet from `sock`"""
-    data = bytearray(sock.recv(20))
+    header = _read_head(sock)
 
-    if len(data) == 0:
+    if len(header) == 0:
         return '', b'', None
 
     # [Address ? bytes]=[Size 4 bytes][DataType 2 bytes][Data ? bytes]
-    content_index = data.index(b'=')
-    packet_size, data_type = struct.unpack('IH', data[content_index + 1:content_index + 7])
+    content_index = header.index(b'=')
+    packet_size, data_type = struct.unpack_from('IH', header, content_index + 1)
     header_size = content_index + 6 + 1
-    bytes_left = packet_size + header_size - len(data)
 
-    # Keep reading until the entire packet is read
-    while bytes_left > 0:
-        buff = sock.recv(bytes_left)
-        data.extend(buff)
-        bytes_left -= len(buff)
+    # Read the rest of the packet directly into a buffer of the full size
+    data = bytearray(packet_size + header_size)
+    received = min(len(header), len(data))
+    data[:received] = header[:received]
+
+    with memoryview(data) as view:
+        while received < len(data):
+            n = sock.recv_into(view[received:])
+            if n == 0:
+                break
+            received += n
 
-    if packet_size + header_size == len(data):
-        logging.info('{} bytes recieved'.format(len(data)))
+    if packet_size + header_size == received:
+        logging.info('{} bytes recieved'.format(received))
     else:
-        logging.error('Incomplete packet recieved {}/{}'.format(packet_size + header_size, len(data)))
+        logging.error('Incomplete packet recieved {}/{}'.format(packet_size + header_size, received))
+        del data[received:]
+
+    return decode_packet(data, reader_id, decode_iif_mine)
+
+
+def _read_head(sock, limit=None):
+    """Read (at least) the address, size, and type of a packet, reading at most `limit` bytes"""
+    head = bytearray()
+    while b'=' not in head or len(head) < head.index(b'=') + 7:
+        want = 20 if limit is None else min(20, limit - len(head))
+        buff = sock.recv(want) if want > 0 else b''
+        if len(buff) == 0:
+            break
+        head.extend(buff)
+    return head
+
+
+def decode_packet(data, reader_id='', decode_iif_mine=False):
+    """Read the address and contents of a complete packet"""
+    if len(data) == 0:
+        return '', b'', None
+
+    content_index = data.index(b'=')
+    packet_size, data_type = struct.unpack('IH', data[content_index + 1:content_index + 7])
+    header_size = content_index + 6 + 1
 
     address = str(data[:content_index], 'ascii')
 
@@ -111,24 +157,235 @@ def read_encoded_socket(sock, reader_id='', decode_iif_mine=False):
 
     ## Decode Data ##
 
-    if decode_iif_mine and (len(address) > 1 or reader_id != address): # Dont read if not my packet
+    if data_type == DataType.POLL: # Always read so the parent knows how long to hold it
+        decoded = float(str(data[header_size:], 'ascii') or 0)
+    elif decode_iif_mine and (len(address) > 1 or reader_id != address): # Dont read if not my packet
         decoded = None
     elif data_type == DataType.TEXT:
         decoded = str(data[header_size:], 'ascii')
     elif data_type == DataType.IMAGE:
-        id = struct.unpack('H', data[header_size:header_size+2])[0]
-        image_data = bytes(data[header_size+2:])
+        id = struct.unpack_from('H', data, header_size)[0]
+        image_data = memoryview(data)[header_size+2:] # A view so the image isn't copied
         decoded = {'current_image': image_data, 'cam': id}
     elif data_type == DataType.JSON:
         decoded = json.loads(data[header_size:])
     elif data_type == DataType.PICKLE:
-        decoded = pickle.loads(data[header_size:])
+        decoded = pickle.loads(memoryview(data)[header_size:])
+    elif data_type == DataType.EVENT:
+        decoded = events.decode_event(memoryview(data)[header_size:])
     else:
         decoded = data
 
     return address, data, decoded
 
 
+def split_packets(data):
+    """Split a batch of concatenated packets"""
+    packets = []
+    start = 0
+    while start < len(data):
+        content_index = data.index(b'=', start)
+        packet_size, _ = struct.unpack_from('IH', data, content_index + 1)
+        end = content_index + 6 + 1 + packet_size
+        packets.append(data[start:end])
+        start = end
+    return packets
+
+
+def get_data_type(data):
+    """Get the type of a complete packet"""
+    content_index = data.index(b'=')
+    return DataType(struct.unpack('H', data[content_index + 5:content_index + 7])[0])
+
+
+def _recv_exact(sock, size):
+    """Read exactly `size` bytes or None if the connection closed"""
+    data = bytearray(size)
+    view = memoryview(data)
+    while size > 0:
+        n = sock.recv_into(view, size)
+        if n == 0:
+            return None
+        view = view[n:]
+        size -= n
+    return data
+
+
+def read_frame(sock):
+    """Read a length-prefixed frame, None if the connection closed"""
+    header = _recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    size, = FRAME_HEADER.unpack(header)
+    return _recv_exact(sock, size)
+
+
+def send_frame(sock, data, prefix=b''):
+    """Send `prefix` + `data` as a length-prefixed frame (without copying `data`)"""
+    sock.sendall(FRAME_HEADER.pack(len(prefix) + len(data)) + prefix)
+    sock.sendall(data)
+
+
+def copy_stream(src, dst, size, chunk_size=64 * 1024):
+    """
+    Copy `size` bytes from socket `src` to socket `dst` through a fixed size buffer.
+
+    If `dst` fails the rest is still read from `src` (so it stays in sync) before raising.
+    """
+    chunk = bytearray(min(chunk_size, max(size, 1)))
+    dst_error = None
+
+    with memoryview(chunk) as view:
+        while size > 0:
+            n = src.recv_into(view, min(len(chunk), size))
+            if n == 0:
+                raise ConnectionError('Connection closed')
+            if dst_error is None:
+                try:
+                    dst.sendall(view[:n])
+                except Exception as e:
+                    dst_error = e
+            size -= n
+
+    if dst_error is not None:
+        raise dst_error
+
+
+def handle_connection(sock, handle_packet, reader_id='', decode_iif_mine=False, max_replies=8, handle_stream=None,
+                      timeout=None, requeue=None):
+    """
+    Read packet(s) from a client and reply with `handle_packet(address, data, decoded, max_replies)`
+
+    `handle_packet` returns a list of packets to send back. Persistent framed connections
+    get them all in one frame, single packet connections only get the first. Framed connections
+    are closed after `timeout` secs without a packet (ex. the client dropped off the network).
+    If the replies can't be sent they're passed to `requeue(replies)` so they aren't lost.
+
+    If `handle_stream(address, head, sock, size, max_replies)` is given, packets (besides polls)
+    are not read, instead it gets the start of the packet and must read the other `size` bytes from `sock`.
+    """
+    sock.settimeout(timeout)
+
+    try:
+        framed = sock.recv(len(FRAME_MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL) == FRAME_MAGIC
+    except socket.timeout:
+        logging.info('Closing idle connection')
+        return
+
+    if framed:
+
+        _recv_exact(sock, len(FRAME_MAGIC))
+
+        # Handle packets until the client disconnects
+        while True:
+            try:
+                header = _recv_exact(sock, FRAME_HEADER.size)
+            except socket.timeout:
+                logging.info('Closing idle connection')
+                break
+            if header is None:
+                break
+            size, = FRAME_HEADER.unpack(header)
+            replies = _handle_incoming(sock, size, handle_packet, handle_stream, reader_id, decode_iif_mine, max_replies)
+            if not _send_replies(sock, replies, requeue, framed=True):
+                break
+
+    else:
+
+        replies = _handle_incoming(sock, None, handle_packet, handle_stream, reader_id, decode_iif_mine, 1)
+        if len(replies) > 0:
+            _send_replies(sock, replies, requeue, framed=False)
+
+
+def _send_replies(sock, replies, requeue, framed):
+    """Send replies to the client, returns False (and requeues them) if it failed"""
+    try:
+        # The client may have given up on a held poll
+        if len(replies) > 0 and _is_closed(sock):
+            raise ConnectionError('Connection closed')
+        if framed:
+            send_frame(sock, b''.join(replies))
+        else:
+            sock.sendall(replies[0])
+        return True
+    except Exception as e:
+        logging.warning('Failed to send replies: {}'.format(e))
+        if requeue is not None and len(replies) > 0:
+            requeue(replies)
+        return False
+
+
+def _is_closed(sock):
+    """Check if the client closed the connection (without reading any of its data)"""
+    readable, _, _ = select.select([sock], [], [], 0)
+    if len(readable) == 0:
+        return False
+    try:
+        return len(sock.recv(1, socket.MSG_PEEK)) == 0
+    except OSError:
+        return True
+
+
+def requeue_packets(packet_queue, packets):
+    """
+    Put packets back at the front of `packet_queue` (keyed by the next hop, the first node of their address)
+    in their original order so they're sent before anything queued since.
+    """
+    by_hop = defaultdict(list)
+    for packet in packets:
+        by_hop[chr(packet[0])].append(packet)
+    for hop, hop_packets in by_hop.items():
+        hop_queue = packet_queue[hop]
+        with hop_queue.not_empty:
+            hop_queue.queue.extendleft(reversed(hop_packets))
+            hop_queue.unfinished_tasks += len(hop_packets)
+            hop_queue.not_empty.notify(len(hop_packets))
+
+
+def _handle_incoming(sock, size, handle_packet, handle_stream, reader_id, decode_iif_mine, max_replies):
+    """Handle a packet of `size` bytes (None if unknown)"""
+    if handle_stream is None:
+        if size is None:
+            return handle_packet(*read_encoded_socket(sock, reader_id, decode_iif_mine), max_replies)
+        data = _recv_exact(sock, size)
+        if data is None:
+            raise ConnectionError('Connection closed')
+        return handle_packet(*decode_packet(data, reader_id, decode_iif_mine), max_replies)
+
+    head = _read_head(sock, size)
+
+    if len(head) == 0:
+        return handle_packet('', b'', None, max_replies)
+
+    content_index = head.index(b'=')
+    packet_size, data_type = struct.unpack_from('IH', head, content_index + 1)
+    bytes_left = content_index + 6 + 1 + packet_size - len(head)
+
+    # Polls are tiny and handled locally, so just read them
+    if DataType(data_type) == DataType.POLL:
+        rest = _recv_exact(sock, bytes_left)
+        if rest is None:
+            raise ConnectionError('Connection closed')
+        return handle_packet(*decode_packet(head + rest, reader_id, decode_iif_mine), max_replies)
+
+    address = str(head[:content_index], 'ascii')
+
+    return handle_stream(address, head, sock, bytes_left, max_replies)
+
+
+def drain_queue(packet_queue, max_packets, wait=0):
+    """Get up to `max_packets` from `packet_queue`, waiting up to `wait` secs for the first"""
+    packets = []
+    try:
+        if wait > 0:
+            packets.append(packet_queue.get(timeout=wait))
+        while len(packets) < max_packets:
+            packets.append(packet_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return packets
+
+
 def send_packet(from_node, hostname, port, data, decode_iif_mine=False, timeout=60):
     """Send a packet to a server"""
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -137,8 +394,9 @@ def send_packet(from_node, hostname, port, data, decode_iif_mine=False, timeout=
     try:
         sock.connect((hostname, port))
 
-        sock.sendall(bytes(from_node, 'ascii') + data)
-        socket_results = read_encoded_socket(sock, decode_iif_mine)
+        sock.sendall(bytes(from_node, 'ascii'))
+        sock.sendall(data)
+        socket_results = read_encoded_socket(sock, from_node, decode_iif_mine)
 
     except Exception as e:
         logging.error('Send packet failed: {}'.format(e))
@@ -148,3 +406,151 @@ def send_packet(from_node, hostname, port, data, decode_iif_mine=False, timeout=
         sock.close()
 
     return socket_results
+
+
+def _is_open(sock):
+    """Check an idle socket wasn't closed by the other side"""
+    readable, _, _ = select.select([sock], [], [], 0)
+    return len(readable) == 0
+
+
+def stream_packet(from_node, hostname, port, head, src, size, decode_iif_mine=False, timeout=60):
+    """Send a packet (`head` + the next `size` bytes of `src`) to a server without buffering it"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+
+    try:
+        sock.connect((hostname, port))
+
+        sock.sendall(bytes(from_node, 'ascii') + head)
+        copy_stream(src, sock, size)
+        socket_results = read_encoded_socket(sock, from_node, decode_iif_mine)
+
+    except Exception as e:
+        logging.error('Stream packet failed: {}'.format(e))
+        socket_results = None, None, None
+
+    finally:
+        sock.close()
+
+    return socket_results
+
+
+class _NotSentError(ConnectionError):
+    """The connection failed before any of the packet was sent"""
+
+
+class Connection:
+    """Persistent connections to a server that each carry many packets"""
+    def __init__(self, hostname, port, max_idle=2):
+        self.hostname = hostname
+        self.port = port
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def send_packet(self, from_node, data, decode_iif_mine=False, timeout=60):
+        """Send a packet to the server (same results as `send_packet`)"""
+        replies = self.request(from_node, data, decode_iif_mine, timeout)
+        if replies is None:
+            return None, None, None
+        elif len(replies) == 0:
+            return '', b'', None
+        return replies[0]
+
+    def request(self, from_node, data, decode_iif_mine=False, timeout=60):
+        """Send a packet to the server and get a list of replies, None if it failed"""
+        try:
+            sock, reused = self._get_socket(timeout)
+        except Exception as e:
+            logging.error('Send packet failed: {}'.format(e))
+            return None
+
+        try:
+            response = self._request(sock, from_node, data, timeout)
+
+        except _NotSentError as e:
+            sock.close()
+
+            if not reused:
+                logging.error('Send packet failed: {}'.format(e))
+                return None
+
+            # The idle connection was dropped by the server before anything was sent, so reconnect and retry
+            # (once anything is sent the server may have handled it, so it isn't retried)
+            logging.info('Reconnecting to {}:{}'.format(self.hostname, self.port))
+            return self.request(from_node, data, decode_iif_mine, timeout)
+
+        except Exception as e:
+            sock.close()
+            logging.error('Send packet failed: {}'.format(e))
+            return None
+
+        self._put_socket(sock)
+
+        return [decode_packet(packet, from_node, decode_iif_mine) for packet in split_packets(response)]
+
+    def stream_request(self, from_node, head, src, size, decode_iif_mine=False, timeout=60):
+        """Stream a packet (`head` + the next `size` bytes of `src`) and get a list of replies, None if it failed"""
+        sock = None
+        try:
+            sock, _ = self._get_socket(timeout)
+            sock.settimeout(timeout)
+
+            prefix = bytes(from_node, 'ascii')
+            sock.sendall(FRAME_HEADER.pack(len(prefix) + len(head) + size) + prefix + head)
+            copy_stream(src, sock, size)
+
+            response = read_frame(sock)
+            if response is None:
+                raise ConnectionError('Connection closed')
+
+        except Exception as e:
+            if sock is not None:
+                sock.close()
+            logging.error('Stream packet failed: {}'.format(e))
+            return None
+
+        self._put_socket(sock)
+
+        return [decode_packet(packet, from_node, decode_iif_mine) for packet in split_packets(response)]
+
+    def close(self):
+        with self.lock:
+            for sock in self.idle:
+                sock.close()
+            self.idle = []
+
+    def _request(self, sock, from_node, data, timeout):
+        sock.settimeout(timeout)
+        prefix = bytes(from_node, 'ascii')
+        header = FRAME_HEADER.pack(len(prefix) + len(data)) + prefix
+        try:
+            sent = sock.send(header)
+        except ConnectionError as e:
+            raise _NotSentError(e)
+        sock.sendall(header[sent:])
+        sock.sendall(data)
+        response = read_frame(sock)
+        if response is None:
+            raise ConnectionError('Connection closed')
+        return response
+
+    def _get_socket(self, timeout):
+        with self.lock:
+            while len(self.idle) > 0:
+                sock = self.idle.pop()
+                if _is_open(sock):
+                    return sock, True
+                sock.close()
+        sock = socket.create_connection((self.hostname, self.port), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(FRAME_MAGIC)
+        return sock, False
+
+    def _put_socket(self, sock):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(sock)
+                return
+        sock.close()
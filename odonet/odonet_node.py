@@ -4,6 +4,7 @@ The OdoNet Node
 from collections import defaultdict
 import socketserver
 import subprocess
+import threading
 import logging
 import struct
 import queue
@@ -15,6 +16,7 @@ from odonet import network_util, wifi_util
 from odonet import node_config, config
 from odonet import events
 from odonet import cameras
+from odonet import devices
 
 
 CUR_DIR = os.path.dirname(__file__)
@@ -38,12 +40,37 @@ class Node:
         self.parent_ip = conf['networking']['parent']['ipv4']
         self.parent_port = conf['networking']['parent']['port']
 
+        # Reuse connections to the parent rather than connecting for every packet
+        if conf['networking']['this'].get('keep_alive', True):
+            self.parent_conn = network_util.Connection(self.parent_ip, self.parent_port)
+        else:
+            self.parent_conn = None
+
+        # Hold a request open at the parent so packets from root get pushed down
+        self.poll_timeout = conf['networking']['this'].get('poll_timeout', 20)
+        self.downlink_batch = conf['networking']['this'].get('downlink_batch', 8)
+
+        # Stream packets from children straight to the parent instead of buffering them
+        self.cut_through = conf['networking']['this'].get('cut_through', True)
+
         # Event Backup
         max_events = conf['about'].get('events_backup_size', 500)
-        self.saved_events_left = max(0, max_events - len(events.load_events()[1]))
+        self.saved_events_left = max(0, max_events - events.count_events())
 
         self.packet_queue = defaultdict(queue.Queue)
 
+        # Devices tick on their own threads and put results here to be sent
+        self.tick_results = queue.Queue(conf['about'].get('results_queue_size', 32))
+        self.stats_freq = conf['about'].get('stats_freq', 100)
+        self.device_loops = []
+
+        # Label events in the background (0 to label them during the tick)
+        ai_queue_size = conf['about'].get('ai_queue_size', 4)
+        if ai_queue_size > 0:
+            self.detection_worker = cameras.DetectionWorker(ai_queue_size, conf['about'].get('ai_queue_mb', 64))
+        else:
+            self.detection_worker = None
+
         # Create TCP server
         this = self
         class TCPTransceiver(socketserver.BaseRequestHandler):
@@ -57,6 +84,7 @@ class Node:
 
     def _init_devices(self):
         """Start up all the devices."""
+        self._stop_devices()
         self.devices = []
 
         for device_conf in self.conf['devices']:
@@ -67,12 +95,35 @@ class Node:
             try:
 
                 if device_type in cameras.CAMERAS:
-                    self.devices.append(cameras.CAMERAS[device_type](device_conf))
+                    camera = cameras.CAMERAS[device_type](device_conf)
+                    camera.detection_worker = self.detection_worker
+                    self._add_device(camera, device_conf)
 
             except Exception as e:
                 logging.error('Failed to init device ({}): {}'.format(device_conf, e))
 
 
+    def _add_device(self, device, device_conf):
+        """Add a device that ticks at its own rate (defaults to the node's)"""
+        idx = len(self.devices)
+        tick_length = device_conf.get('tick_length', self.tick_length)
+        self.devices.append(device)
+        self.device_loops.append(devices.DeviceLoop(idx, device, tick_length, self.tick_results))
+
+
+    def _start_devices(self):
+        """Start ticking all the devices"""
+        for device_loop in self.device_loops:
+            device_loop.start()
+
+
+    def _stop_devices(self):
+        """Stop ticking all the devices"""
+        for device_loop in self.device_loops:
+            device_loop.stop()
+        self.device_loops = []
+
+
     def run(self):
         """Start the server"""
         with network_util.create_server(self.my_ip, self.my_port, self.TCPTransceiver) as server:
@@ -83,6 +134,13 @@ class Node:
             self._send_msg(self.my_id + '-boot')
             self._send_obj(self.conf)
 
+            self._start_devices()
+
+            if self.poll_timeout > 0:
+                poll_thread = threading.Thread(target=self._poll_parent)
+                poll_thread.daemon = True
+                poll_thread.start()
+
             # Keep track of loops
             ticks = 0
 
@@ -94,10 +152,19 @@ class Node:
                 if ticks % self.ping_freq == 0:
                     self._send_msg(self.my_id + '-tick', timeout=2)
 
-                # Run though all the devices
-                for idx, device in enumerate(self.devices):
+                # Report how long devices are taking to tick
+                if ticks % self.stats_freq == 0:
+                    self._send_tick_times()
+
+                # Send device results until the next tick
+                while True:
+
+                    time_left = self.tick_length - time.time() + start
 
-                    tick_result = device.tick()
+                    try:
+                        idx, tick_result = self.tick_results.get(timeout=max(0, time_left))
+                    except queue.Empty:
+                        break
 
                     if tick_result.image is not None:
 
@@ -105,26 +172,44 @@ class Node:
 
                     if tick_result.event is not None:
 
-                        event = tick_result.event
-                        event.node = self.my_id
-                        event_sent = self._send_obj(event)
+                        self._send_event(tick_result.event)
 
-                        # Backup event
-                        if not event_sent and self.saved_events_left > 0:
-                            self.saved_events_left -= 1
-                            events.save_event(event, thumb=False, gif=False)
+                    if time_left <= 0:
+                        break
 
-                # Make sure the device isnt ticking too fast
-                # to prevent too much traffic and high power consumption
-                time_left = max(0, self.tick_length - time.time() + start)
-                time.sleep(time_left)
+                # Send events labeled in the background
+                if self.detection_worker is not None:
+                    for event in self.detection_worker.get_finished():
+                        self._send_event(event)
 
                 ticks += 1
 
 
     def _handle_tcp(self, tcp):
-        """Handle a packet from a child"""
-        address, data, decoded = network_util.read_encoded_socket(tcp.request, decode_iif_mine=True)
+        """Handle a connection from a child"""
+        handle_stream = self._handle_stream if self.cut_through else None
+        network_util.handle_connection(tcp.request, self._handle_packet,
+                                       decode_iif_mine=True, max_replies=self.downlink_batch,
+                                       handle_stream=handle_stream, timeout=self.poll_timeout * 2 + 10,
+                                       requeue=self._requeue)
+
+
+    def _requeue(self, packets):
+        """Put packets that couldn't be sent to a child back in its queue"""
+        network_util.requeue_packets(self.packet_queue, packets)
+
+
+    def _handle_packet(self, address, data, decoded, max_replies):
+        """Handle a packet from a child, returns packets to send back"""
+        if len(address) == 0:
+            return []
+
+        last_node_id = address[0]
+
+        # Hold polls until there's data for the child
+        if network_util.get_data_type(data) == network_util.DataType.POLL:
+            wait = min(decoded, self.poll_timeout)
+            return network_util.drain_queue(self.packet_queue[last_node_id], max_replies, wait)
 
         logging.info('Routing {} -> @'.format(address))
 
@@ -132,11 +217,37 @@ class Node:
         self._forward_packet(data)
 
         # See if the child node has data ready for it
-        last_node_id = address[0]
+        return network_util.drain_queue(self.packet_queue[last_node_id], max_replies)
+
+
+    def _handle_stream(self, address, head, sock, size, max_replies):
+        """Stream a packet from a child to the parent, returns packets to send back"""
+        logging.info('Streaming {} -> @'.format(address))
+
+        if self.parent_conn is not None:
+            replies = self.parent_conn.stream_request(self.my_id, head, sock, size,
+                                                      decode_iif_mine=True, timeout=self.timeout)
+        else:
+            reply = network_util.stream_packet(self.my_id,
+                                               self.parent_ip,
+                                               self.parent_port,
+                                               head, sock, size,
+                                               decode_iif_mine=True,
+                                               timeout=self.timeout)
+            replies = None if reply[1] is None else [reply]
+
+        self._handle_replies(replies)
+
+        # See if the child node has data ready for it
+        return network_util.drain_queue(self.packet_queue[address[0]], max_replies)
 
-        if last_node_id in self.packet_queue and not self.packet_queue[last_node_id].empty():
 
-            tcp.request.sendall(self.packet_queue[last_node_id].get())
+    def _poll_parent(self):
+        """Keep a poll open at the parent to receive packets as soon as they're queued"""
+        packet = network_util.construct_packet('', network_util.DataType.POLL, str(self.poll_timeout))
+        while True:
+            if not self._forward_packet(packet, timeout=self.poll_timeout + self.timeout):
+                time.sleep(self.timeout)
 
 
     def _handle_root_cmd(self, decoded):
@@ -152,6 +263,10 @@ class Node:
 
         elif decoded == 'reload':
             self._init_devices()
+            self._start_devices()
+
+        elif decoded == 'ticktimes':
+            self._send_tick_times()
 
         elif decoded == 'wifisignal':
             quality, strength = self._get_wifi_signal()
@@ -161,6 +276,9 @@ class Node:
             config.set_config(decoded)
             self.conf = decoded
 
+        elif type(decoded) == dict and 'ping' in decoded:
+            self._send_obj({'pong': decoded['ping']})
+
         elif type(decoded) == dict and 'movecam' in decoded:
             camera = self.cameras[decoded['movecam']]
             camera.move(decoded['dir'])
@@ -190,21 +308,38 @@ class Node:
         if timeout is None:
             timeout = self.timeout
 
-        address, data, decoded = network_util.send_packet(self.my_id,
-                                                          self.parent_ip,
-                                                          self.parent_port,
-                                                          data,
-                                                          decode_iif_mine=True,
-                                                          timeout=timeout)
-
-        if data is None:
+        if self.parent_conn is not None:
+            replies = self.parent_conn.request(self.my_id,
+                                               data,
+                                               decode_iif_mine=True,
+                                               timeout=timeout)
+        else:
+            address, data, decoded = network_util.send_packet(self.my_id,
+                                                              self.parent_ip,
+                                                              self.parent_port,
+                                                              data,
+                                                              decode_iif_mine=True,
+                                                              timeout=timeout)
+            replies = None if data is None else [(address, data, decoded)]
+
+        return self._handle_replies(replies)
+
+
+    def _handle_replies(self, replies):
+        """Handle packets the parent sent back"""
+        if replies is None:
             logging.error('Packet forwarding failed')
             return False
 
-        elif len(data) > 0:
-            if len(address) == 1: # This packet is for me
+        for address, data, decoded in replies:
+            if len(data) == 0:
+                continue
+            elif len(address) == 1: # This packet is for me
                 logging.info('Received ({})'.format(type(decoded)))
-                self._handle_root_cmd(decoded)
+                try:
+                    self._handle_root_cmd(decoded)
+                except Exception as e: # Dont drop the rest of the batch
+                    logging.error('Root cmd failed: {}'.format(e))
             else: # Send this packet to the next node in the address
                 logging.info('Routing {} -> {}'.format(self.my_id, address[1]))
                 self.packet_queue[address[1]].put(data[1:])
@@ -232,6 +367,26 @@ class Node:
         return self._forward_packet(packet)
 
 
+    def _send_event(self, event):
+        """Send event to root, backing it up if it fails"""
+        event.node = self.my_id
+        packet = network_util.construct_packet('', network_util.DataType.EVENT, events.encode_event(event))
+        event_sent = self._forward_packet(packet)
+
+        # Backup event
+        if not event_sent and self.saved_events_left > 0:
+            self.saved_events_left -= 1
+            events.save_event(event, thumb=False, gif=False)
+
+        return event_sent
+
+
+    def _send_tick_times(self):
+        """Send the tick latency of each device to root"""
+        tick_times = {str(device_loop.idx): device_loop.stats() for device_loop in self.device_loops}
+        return self._send_obj({'ticktimes': tick_times})
+
+
     def _get_wifi_signal(self):
         """Determine current WiFi signal quality/strength"""
         ssid = self.conf['networking']['parent']['ssid']
@@ -29,6 +29,8 @@ class Node:
         self.web_ip = conf['networking']['this'].get('web_ipv4', '0.0.0.0')
         self.web_port = conf['networking']['this'].get('web_port', 5000)
         self.secret = conf['security']['secret']
+        self.poll_timeout = conf['networking']['this'].get('poll_timeout', 20)
+        self.downlink_batch = conf['networking']['this'].get('downlink_batch', 8)
 
         self.packet_queue = defaultdict(queue.Queue)
         self.routes = {}
@@ -44,6 +46,9 @@ class Node:
         self.app = webapp.app
         self.app.handle_web_msg = self._handle_web_server
         self.node_data = self.app.odonet
+        self.node_data['files'].max_bytes = conf['about'].get('file_cache_mb', 256) * 1024 * 1024
+        self.gif_preview = conf['about'].get('gif_preview', True)
+        self.live_buffer = conf['about'].get('live_buffer', 4)
 
 
     def run(self):
@@ -62,7 +67,8 @@ class Node:
 
         if name == 'reset':
             self.node_data['devices'] = {}
-            self.node_data['files'] = {}
+            self.node_data['files'].clear()
+            self.node_data['live'].clear()
             self.routes = {}
             self._web_update('page')
             return {}
@@ -72,6 +78,10 @@ class Node:
             node, new_config = data['id'], data['conf']
             old_config = self.node_data['devices'][node]['config']
 
+            error = config.check_regions(new_config)
+            if error is not None:
+                return {'alert': error}
+
             if not config.is_same_config(old_config, new_config):
                 self._send_obj(node, new_config)
 
@@ -144,6 +154,10 @@ class Node:
             self._delete_node(cur_id)
             self._web_update('page')
 
+        elif name == 'ping':
+            node = data['id']
+            self._send_obj(node, {'ping': time.time()})
+
         elif name == 'move-cam':
             cur_id, cam, dir = data['id'], data['cam'], data['dir']
             self._send_obj(cur_id, {'movecam': cam, 'dir': dir})
@@ -160,30 +174,43 @@ class Node:
 
 
     def _handle_tcp(self, tcp):
-        """Handle a packet from a child"""
-        address, data, decoded = network_util.read_encoded_socket(tcp.request)
+        """Handle a connection from a child"""
+        network_util.handle_connection(tcp.request, self._handle_packet, max_replies=self.downlink_batch,
+                                       timeout=self.poll_timeout * 2 + 10, requeue=self._requeue)
+
+
+    def _requeue(self, packets):
+        """Put packets that couldn't be sent to a child back in its queue"""
+        network_util.requeue_packets(self.packet_queue, packets)
+
+
+    def _handle_packet(self, address, data, decoded, max_replies):
+        """Handle a packet from a child, returns packets to send back"""
 
         # Ignore malformed packet
         if len(address) == 0:
             logging.error('Packet w/o address')
-            return
+            return []
 
         origin_node_id = address[-1] # The node the packet started from
         last_node_id = address[0] # The node the packet just came from
 
-        logging.info('Packet from {} ({})'.format(address, type(decoded)))
-
-        # See if child node has data for it
-        if last_node_id in self.packet_queue and not self.packet_queue[last_node_id].empty():
+        # Hold polls until there's data for the child
+        if network_util.get_data_type(data) == network_util.DataType.POLL:
+            wait = min(decoded, self.poll_timeout)
+            return network_util.drain_queue(self.packet_queue[last_node_id], max_replies, wait)
 
-            tcp.request.sendall(self.packet_queue[last_node_id].get())
+        logging.info('Packet from {} ({})'.format(address, type(decoded)))
 
         # Save the route the packet came through
         self.routes[origin_node_id] = address
 
-        # Handle data sent
+        # Handle data sent (before draining so queued packets aren't lost if this fails)
         self._handle_node_data(address, origin_node_id, decoded)
 
+        # See if child node has data for it
+        return network_util.drain_queue(self.packet_queue[last_node_id], max_replies)
+
 
     def _handle_node_data(self, address, node, decoded):
         """Handle data coming from a node"""
@@ -195,12 +222,16 @@ class Node:
                 'name': 'New Device',
                 'id': node,
                 'wifi_quality': None,
+                'tick_times': None,
+                'cmd_latency': None,
                 'config': None
             }
 
-            # Ask for its config and signal
+            # Ask for its config, signal, and device tick times
             self._send_msg(node, 'config')
             self._send_msg(node, 'wifisignal')
+            self._send_msg(node, 'ticktimes')
+            self._send_obj(node, {'ping': time.time()})
 
         # Update saved node data
         device = self.node_data['devices'][node]
@@ -224,13 +255,20 @@ class Node:
         elif type(decoded) == dict and 'wifiquality' in decoded:
             device['wifi_quality'] = decoded['wifiquality']
 
+        elif type(decoded) == dict and 'ticktimes' in decoded:
+            device['tick_times'] = decoded['ticktimes']
+
+        elif type(decoded) == dict and 'pong' in decoded:
+            device['cmd_latency'] = round(time.time() - decoded['pong'], 3)
+            logging.info('Command round trip to {} took {}s'.format(node, device['cmd_latency']))
+
         elif type(decoded) == dict and 'shelloutput' in decoded:
             logging.info(decoded['shelloutput'])
 
         elif type(decoded) == events.Event:
             decoded.node = node
             logging.info('Received Event {}'.format(decoded))
-            events.save_event(decoded)
+            events.save_event(decoded, preview=self.gif_preview)
             self._web_update('new_event')
 
         elif type(decoded) == dict and 'current_image' in decoded:
@@ -238,27 +276,44 @@ class Node:
             cam_id, image_data = decoded['cam'], decoded['current_image']
 
             files_path = 'current_image_{}'.format(cam_id)
+            live_path = 'live_image_{}'.format(cam_id)
+            streaming = self._is_streaming(device, cam_id)
 
-            if files_path in device:
-                del self.node_data['files'][device[files_path]]
-            else:
+            # New camera or it switched modes
+            if files_path not in device or device.get(live_path) != streaming:
                 self._web_update('page')
+            device[live_path] = streaming
+
+            if streaming: # Stream cameras are served as MJPEG
+
+                live_name = '{}_{}'.format(node, cam_id)
+
+                if live_name not in self.node_data['live']:
+                    self.node_data['live'][live_name] = webapp.LiveFeed(self.live_buffer)
+
+                device[files_path] = live_name
+                self.node_data['live'][live_name].push(image_data)
+
+            else: # Monitor snapshots are just files
+
+                if files_path in device:
+                    self.node_data['files'].pop(device[files_path])
+
+                fn = '{}_current_image_{}_{}.jpg'.format(node, cam_id, time.time())
+                self.node_data['files'][fn] = (image_data, 'image/jpeg') # a view of the packet, not copied
+                device[files_path] = fn
+                self._web_update(files_path, fn, node)
+
 
-            fn = '{}_current_image_{}_{}.jpg'.format(node, cam_id, time.time())
-            self.node_data['files'][fn] = (image_data, 'image/jpeg')
-            device[files_path] = fn
-            self._web_update(files_path, fn, node)
+    def _is_streaming(self, device, cam_id):
+        """Is the camera in stream mode (from the device stats sent with tick times)"""
+        tick_times = device.get('tick_times') or {}
+        return tick_times.get(str(cam_id), {}).get('mode') == 'stream'
 
 
     def _web_update(self, key, value=True, node=None):
         """Tell the webapp something updated"""
-        if node is None:
-            self.node_data['update'][key] = value
-        else:
-            node_key = 'node_' + node
-            if node_key not in self.node_data['update']:
-                self.node_data['update'][node_key] = {}
-            self.node_data['update'][node_key][key] = value
+        self.node_data['update'].push(key, value, node)
 
 
     def _delete_node(self, node):
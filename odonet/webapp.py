@@ -1,9 +1,12 @@
 """
 The flask webapp for interacting with the OdoNet Root
 """
-from flask import Flask, render_template, send_file, request, jsonify
+from flask import Flask, Response, render_template, send_file, request, jsonify
+from collections import OrderedDict, deque
 from datetime import datetime
+import threading
 import logging
+import json
 import os
 import io
 
@@ -19,18 +22,158 @@ app = Flask('OdoNet',
 # Dont really need Flask logs
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
+
+class FileCache:
+    """
+    A LRU cache of files served by the webapp limited to `max_bytes`
+
+    Entries are either (data, file_type) kept in memory or the path of a file on disk.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_entries=10000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __setitem__(self, name, value):
+        data, file_type = value
+        self._put(name, (data, file_type, False), len(data))
+
+    def add_path(self, name, path, file_type):
+        """Serve the file at `path` as `name` without loading it"""
+        self._put(name, (path, file_type, True), 0)
+
+    def get(self, name):
+        """Get (data or path, file_type, is_path) or None"""
+        with self.lock:
+            if name not in self.files:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.files.move_to_end(name)
+            return self.files[name][0]
+
+    def pop(self, name, default=None):
+        with self.lock:
+            if name not in self.files:
+                return default
+            entry, size = self.files.pop(name)
+            self.size -= size
+            return entry
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.files),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def _put(self, name, entry, size):
+        with self.lock:
+            if name in self.files:
+                self.size -= self.files.pop(name)[1]
+            self.files[name] = (entry, size)
+            self.size += size
+            while len(self.files) > 1 and (self.size > self.max_bytes or len(self.files) > self.max_entries):
+                _, (_, old_size) = self.files.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+
+
+class LiveFeed:
+    """
+    A ring buffer of the latest JPEG frames of a camera shared by all of its viewers
+
+    Frames are numbered so each viewer can wait for a newer one than it last sent.
+    """
+    def __init__(self, size=4):
+        self.frames = deque(maxlen=size)
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def push(self, data):
+        with self.cond:
+            self.seq += 1
+            self.frames.append((self.seq, data))
+            self.cond.notify_all()
+
+    def wait(self, after=0, timeout=None):
+        """Get the newest (seq, data) after `after`, or the newest frame after `timeout` secs"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > after, timeout=timeout)
+            if not self.frames:
+                return after, None
+            return self.frames[-1]
+
+
+class UpdateFeed:
+    """
+    The recent updates for the webapp, every client reads them from its own cursor
+
+    Entries are (seq, node, key, value) where node is None for global updates.
+    """
+    def __init__(self, size=256):
+        self.updates = deque(maxlen=size)
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def push(self, key, value=True, node=None):
+        with self.cond:
+            self.seq += 1
+            self.updates.append((self.seq, node, key, value))
+            self.cond.notify_all()
+
+    def wait(self, after, timeout=None):
+        """
+        Wait for updates after the cursor `after`.
+
+        Returns the new cursor and the updates merged as {key: value, 'node_<id>': {key: value}}
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > after, timeout=timeout)
+
+            # The client fell too far behind, just have it reload
+            if self.updates and self.updates[0][0] > after + 1:
+                return self.seq, {'page': True}
+
+            merged = {}
+            for seq, node, key, value in self.updates:
+                if seq <= after:
+                    continue
+                if node is None:
+                    merged[key] = value
+                else:
+                    merged.setdefault('node_' + node, {})[key] = value
+            return self.seq, merged
+
+
 # This object will be used to pass data to and from the OdoNet server
 app.odonet = {}
 app.odonet['devices'] = {}
-app.odonet['files'] = {}
-app.odonet['update'] = {}
+app.odonet['files'] = FileCache()
+app.odonet['update'] = UpdateFeed()
+app.odonet['live'] = {}
 
 
 def _load_file(fn, files_path, files, data_type):
-    """Load data from `fn` and store it in `files` under the name `files_path`"""
+    """Serve the file `fn` from `files` under the name `files_path`"""
     if files_path not in files and os.path.exists(fn):
-        with open(fn, 'rb') as data_file:
-            app.odonet['files'][files_path] = (data_file.read(), data_type)
+        files.add_path(files_path, fn, data_type)
 
 
 @app.route('/')
@@ -42,7 +185,19 @@ def index():
 @app.route('/events')
 def get_events():
     """View all events"""
-    events_size, all_events = events.load_events()
+    page = request.args.get('page', 0, type=int)
+    per_page = request.args.get('per_page', 1000, type=int)
+
+    # Optional filters
+    filters = {
+        'node': request.args.get('node'),
+        'start': _parse_date(request.args.get('start')),
+        'end': _parse_date(request.args.get('end')),
+        'min_score': request.args.get('min_score', type=int)
+    }
+
+    events_size, all_events = events.load_events(limit=per_page, offset=page * per_page, **filters)
+    num_events = events.count_events(**filters)
 
     devices = set()
 
@@ -52,28 +207,39 @@ def get_events():
         devices.add(id)
 
         _load_file(base_fn + '.jpg', event_name + '.jpg', app.odonet['files'], 'image/jpeg')
+        _load_file(base_fn + '.preview.gif', event_name + '.preview.gif', app.odonet['files'], 'image/gif')
 
     devices = sorted(devices)
 
     return render_template('events.html',
                            events=all_events, date_now=datetime.now(),
                            device_list=devices, size=round(events_size / 1e9, 2),
-                           num_events=len(all_events), **app.odonet)
+                           num_events=num_events, page=page,
+                           has_next=(page + 1) * per_page < num_events,
+                           args=request.args, **app.odonet)
+
+
+def _parse_date(date_str):
+    """Parse a YYYY-MM-DD date from the query string"""
+    if not date_str:
+        return None
+    return datetime.strptime(date_str, '%Y-%m-%d')
 
 
 @app.route('/event/<event_name>')
 def view_event(event_name=''):
     """View an individual event"""
-    base_fn, event = events.load_event(event_name)
+    base_fn, event = events.open_event(event_name)
 
     # Load the event's gif
     _load_file(base_fn + '.gif', event_name + '.gif', app.odonet['files'], 'image/gif')
 
-    # Load individual frames
-    for i, (date, image_data, motion, objects) in enumerate(event.images):
-        img_name = '{}_img_{}.jpg'.format(event_name, i)
-        if img_name not in app.odonet['files']:
-            app.odonet['files'][img_name] = (image_data, 'image/jpeg')
+    # Old pickled events are loaded whole, so keep their frames
+    if not isinstance(event, events.EventFile):
+        for i, (date, image_data, motion, objects) in enumerate(event.images):
+            img_name = '{}_img_{}.jpg'.format(event_name, i)
+            if img_name not in app.odonet['files']:
+                app.odonet['files'][img_name] = (image_data, 'image/jpeg')
 
     return render_template('event.html',
                            event_name=event_name, event=event,
@@ -90,23 +256,89 @@ def put_data(name=''):
     return jsonify(result)
 
 
-@app.route('/update')
-def update_ready():
-    """Read updates that have occured since the last call"""
-    updates = app.odonet['update']
-    app.odonet['update'] = {}
-    return jsonify(updates)
+@app.route('/updates')
+def stream_updates():
+    """Push updates to the browser as server-sent events"""
+    feed = app.odonet['update']
+    return Response(_stream_updates(feed, feed.seq), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+def _stream_updates(feed, seq, timeout=30):
+    while True:
+        seq, updates = feed.wait(seq, timeout)
+        if updates:
+            yield 'data: {}\n\n'.format(json.dumps(updates))
+        else:
+            # Comment line to keep the connection alive
+            yield ': ping\n\n'
+
+
+@app.route('/live/<node>/<int:cam>')
+def live_feed(node='', cam=0):
+    """Stream a camera's current images as MJPEG"""
+    feed = app.odonet['live'].get('{}_{}'.format(node, cam))
+    if feed is None:
+        return 'Feed not found'
+
+    return Response(_stream_feed(feed), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+def _stream_feed(feed, timeout=30):
+    seq = 0
+    while True:
+        # Resend the last frame on timeout so closed connections are noticed
+        seq, data = feed.wait(seq, timeout)
+        if data is not None:
+            yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + \
+                str(len(data)).encode() + b'\r\n\r\n' + bytes(data) + b'\r\n'
 
 
 @app.route('/files/<filename>')
 def get_file(filename=''):
-    """Download file stored as bytes in `app.odonet['files']`"""
-    if filename in app.odonet['files']:
-        data, file_type = app.odonet['files'][filename]
-        buffer = io.BytesIO(data)
-        return send_file(buffer,
-                         attachment_filename=filename,
+    """Download file stored in `app.odonet['files']`"""
+    entry = app.odonet['files'].get(filename)
+    if entry is None:
+        return 'File not found'
+
+    data, file_type, is_path = entry
+    if is_path:
+        return send_file(data,
                          mimetype=file_type,
                          cache_timeout=None)
-    else:
+
+    buffer = io.BytesIO(data)
+    return send_file(buffer,
+                     attachment_filename=filename,
+                     mimetype=file_type,
+                     cache_timeout=None)
+
+
+@app.route('/files/frames/<event_name>/<int:idx>')
+def get_event_frame(event_name='', idx=0):
+    """Download a single frame of a saved event"""
+    img_name = '{}_img_{}.jpg'.format(event_name, idx)
+
+    if img_name in app.odonet['files']:
+        return get_file(img_name)
+
+    base_fn, event = events.open_event(event_name)
+    if idx >= len(event):
         return 'File not found'
+
+    if isinstance(event, events.EventFile):
+        image_data = event.read_frame(idx)
+    else:
+        image_data = event.images[idx][1]
+
+    return send_file(io.BytesIO(image_data),
+                     attachment_filename=img_name,
+                     mimetype='image/jpeg',
+                     cache_timeout=None)
+
+
+@app.route('/files-stats')
+def get_files_stats():
+    """Hit/miss and size stats of the file cache"""
+    return jsonify(app.odonet['files'].stats())
+
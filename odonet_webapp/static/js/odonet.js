@@ -6,17 +6,13 @@ let WEB_URL = window.location.origin;
 
 $(document).ready(() => {
 
-  // Poll the server for updates
-  setInterval(() => {
-    fetch(WEB_URL + '/update', {
-        method: "GET"
-    })
-    .then(response => response.json())
-    .then(updated => {
-      console.log(updated);
-      onRootUpdate(updated);
-    });
-  }, 500);
+  // Listen for updates pushed by the server
+  let updates = new EventSource(WEB_URL + '/updates');
+  updates.onmessage = (msg) => {
+    let updated = JSON.parse(msg.data);
+    console.log(updated);
+    onRootUpdate(updated);
+  };
 
 });
 
@@ -0,0 +1,17 @@
+"""
+Rebuild the events index from the events saved on disk
+
+$ python rebuild_index.py
+"""
+import logging
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] (%(levelname)s) %(message)s')
+
+from odonet import events
+
+
+if __name__ == "__main__":
+
+    events.rebuild_index()
+
+    events_size, _ = events.load_events(limit=0)
+    logging.info('Indexed {} events ({} GB)'.format(events.count_events(), round(events_size / 1e9, 2)))
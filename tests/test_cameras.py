@@ -0,0 +1,153 @@
+"""
+Camera motion detection tests
+
+$ python -m pytest tests
+"""
+import numpy as np
+import pytest
+import cv2
+
+from odonet import cameras
+
+
+def _nrmse(a, b):
+    a, b = a.astype(np.float64), b.astype(np.float64)
+    return np.sqrt(np.mean((a - b) ** 2)) / np.sqrt(np.mean(a ** 2))
+
+
+def _ssim(a, b, multichannel=True):
+    a, b = a.astype(np.float64), b.astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    blur = lambda img: cv2.GaussianBlur(img, (7, 7), 1.5)
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    ssim = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return ssim.mean()
+
+
+@pytest.fixture(autouse=True)
+def motion_score(monkeypatch):
+    """Stand-ins for the skimage metrics `compute_motion_score` uses"""
+    monkeypatch.setattr(cameras, 'compare_nrmse', _nrmse, raising=False)
+    monkeypatch.setattr(cameras, 'compare_ssim', _ssim, raising=False)
+
+
+_rng = np.random.RandomState(0)
+BACKGROUND = cv2.GaussianBlur(_rng.randint(0, 255, (300, 300, 3)).astype(np.uint8), (9, 9), 3)
+OBJECT = _rng.randint(0, 255, (150, 110, 3)).astype(np.uint8)
+
+
+def _scene(step):
+    """A static scene with a textured object moving across it"""
+    img = BACKGROUND.copy()
+    x = 10 + (step * 60) % 180
+    img[80:230, x:x + 110] = OBJECT
+    return img
+
+
+class FakeCamera(cameras.BaseCamera):
+
+    def __init__(self, cam_conf, moving_from=0):
+        super().__init__(cam_conf)
+        self.step = 0
+        self.moving_from = moving_from
+
+    def capture_frame(self):
+        self.step += 1
+        return cameras.Frame(array=_scene(max(self.step, self.moving_from)))
+
+
+def _event_frames(camera, ticks):
+    frames = 0
+    for _ in range(ticks):
+        camera.monitor_tick()
+        frames += len(camera.cur_event_images)
+        camera.cur_event_images = []
+        camera.cur_event = None
+    return frames
+
+
+@pytest.mark.parametrize('prefilter', [True, False])
+def test_fixed_threshold_detects_motion(prefilter):
+    conf = {'motion': 100, 'motion_prefilter': prefilter, 'use_ai': False, 'rate': 1e9}
+    assert _event_frames(FakeCamera(conf), 60) > 50
+
+
+def test_static_scene_skips_full_score():
+    scorer = cameras.MotionScorer()
+    still = _scene(0)
+    frames = [still + np.uint8(i % 2) for i in range(100)]
+    full = 0
+    for prev, cur in zip(frames, frames[1:]):
+        scorer.score(prev, cur, threshold=100)
+        full += scorer.full
+    assert full < 30
+
+
+def test_ratio_recovers_after_lighting_change():
+    scorer = cameras.MotionScorer(calibrate=5, full_every=5)
+    for step in range(10):
+        scorer.score(_scene(step), _scene(step + 1))
+    calibrated = scorer.ratio
+
+    scorer.score(_scene(0), cv2.add(_scene(0), np.full((300, 300, 3), 30, np.uint8)))
+    assert scorer.min_ratio <= scorer.ratio < calibrated
+
+    for step in range(100):
+        scorer.score(_scene(step), _scene(step + 1), threshold=100)
+    assert scorer.ratio > 0.8 * calibrated
+
+
+def test_adaptive_rate_scores_against_max_tick_old_frame():
+    camera = FakeCamera({'adaptive_rate': {'min_tick': 1, 'max_tick': 4}})
+    refs = [camera._reference_roi(t, t) for t in range(10)]
+    assert refs == [None, 0, 0, 0, 0, 1, 2, 3, 4, 5]
+
+
+def test_adaptive_rate_scales_event_size():
+    camera = FakeCamera({'adaptive_rate': {'min_tick': 0.2}, 'max_event_size': 16})
+    assert camera._max_event_frames() == 16
+    camera.next_tick_length(0.8)
+    assert camera._max_event_frames() == 64
+
+
+class NoisyCamera(FakeCamera):
+
+    def capture_frame(self):
+        self.step += 1
+        return cameras.Frame(array=_scene(0) + _rng.randint(0, 3, (300, 300, 3)).astype(np.uint8))
+
+
+def test_auto_threshold_learns_only_full_scores():
+    camera = NoisyCamera({'motion': 'auto', 'motion_auto': {'warmup': 5}, 'use_ai': False, 'rate': 1e9})
+    camera.monitor_tick()
+    full = 0
+    for _ in range(100):
+        camera.monitor_tick()
+        full += camera.motion_scorer.full
+    assert full < 100
+    assert camera.auto_threshold.count == full
+
+
+def test_event_frames_drop_full_size_arrays():
+    camera = FakeCamera({'motion': 100, 'use_ai': False, 'rate': 1e9})
+    for _ in range(5):
+        camera.monitor_tick()
+    assert len(camera.cur_event_images) > 0
+    for frame, _ in camera.cur_event_images:
+        assert frame._array is None
+        assert frame.shape == (300, 300, 3)
+        assert frame.small.shape == (300, 300, 3)
+        assert cv2.imdecode(np.frombuffer(frame.jpeg, np.uint8), cv2.IMREAD_COLOR).shape == frame.shape
+
+
+def test_scorer_caches_reference_frames():
+    scorer = cameras.MotionScorer()
+    frames = [_scene(step) for step in range(6)]
+    for frame in frames[1:]: # always against the same reference, like adaptive rate
+        scorer.score(frames[0], frame, threshold=100)
+    assert len(scorer.grays) == len(frames)
+    del frames, frame
+    assert len(scorer.grays) == 0
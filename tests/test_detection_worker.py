@@ -0,0 +1,75 @@
+"""
+Background object detection tests
+
+$ python -m pytest tests
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+import cv2
+
+from odonet import cameras, events
+
+
+FRAME_SHAPE = (1080, 1920, 3)
+
+
+@pytest.fixture
+def blocked(monkeypatch):
+    """Hold the worker in labeling until set (detection is skipped since there's no model here)"""
+    release = threading.Event()
+    def label(event, event_images, use_ai=True, batch_size=16, region=None):
+        release.wait()
+        return cameras.label_event(event, event_images, use_ai=False)
+    monkeypatch.setattr(cameras, 'label_event_safe', label)
+    yield release
+    release.set()
+
+
+def _event_images(n):
+    rng = np.random.RandomState(0)
+    img = cv2.GaussianBlur(rng.randint(0, 255, FRAME_SHAPE).astype(np.uint8), (9, 9), 3)
+    return [(cameras.Frame(array=img.copy()), 100) for _ in range(n)]
+
+
+def _wait_for(check, timeout=5):
+    start = time.time()
+    while not check() and time.time() - start < timeout:
+        time.sleep(0.01)
+    return check()
+
+
+def test_burst_drops_events_without_keeping_arrays(blocked):
+    worker = cameras.DetectionWorker(max_pending=2)
+    submitted = []
+    for _ in range(6):
+        event, event_images = events.Event(), _event_images(4)
+        queued = worker.submit(event, event_images)
+        submitted.append((queued, event_images))
+
+    # One is being labeled, two are waiting, the rest are sent w/o detection by the camera
+    assert [queued for queued, _ in submitted] == [True, True, True, False, False, False]
+
+    # Waiting events only hold the JPEG and small frames
+    for queued, event_images in submitted[:3]:
+        for frame, _ in event_images:
+            assert frame._array is None
+            assert frame.shape == FRAME_SHAPE
+    assert worker.pending_bytes < 3 * 4 * np.prod(FRAME_SHAPE)
+
+    blocked.set()
+    assert _wait_for(lambda: worker.finished.qsize() == 3)
+    assert [len(event.images) for event in worker.get_finished()] == [4, 4, 4]
+    assert _wait_for(lambda: worker.pending_bytes == 0)
+
+
+def test_queue_bounded_by_bytes(blocked):
+    # Each frame is ~0.8MB compacted (JPEG + small)
+    worker = cameras.DetectionWorker(max_pending=100, max_pending_mb=2)
+    assert worker.submit(events.Event(), _event_images(1))
+    assert _wait_for(lambda: worker.pending.empty())
+    queued = [worker.submit(events.Event(), _event_images(1)) for _ in range(5)]
+    assert queued == [True, False, False, False, False]
+    assert worker.pending_bytes <= worker.max_pending_bytes
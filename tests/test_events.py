@@ -0,0 +1,36 @@
+"""
+Saved event tests
+
+$ python -m pytest tests
+"""
+import os
+
+from odonet import events
+
+
+def _write_event(path, frames):
+    event = events.Event()
+    event.node = 'A'
+    for i in range(frames):
+        event.add_image_data(b'frame %d' % i, motion=i)
+    events.score(event)
+    with open(path, 'wb') as event_file:
+        event_file.write(events.encode_event(event))
+
+
+def test_open_event_sees_rewritten_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(events, 'EVENTS_PATH', str(tmp_path))
+    name = '2020-01-01-00-00-00_A_0_2'
+    os.makedirs(os.path.join(str(tmp_path), 'A'))
+    fn = os.path.join(str(tmp_path), 'A', name + '.bin')
+
+    _write_event(fn, 2)
+    _, event = events.open_event(name)
+    assert len(event) == 2
+    assert event.read_frame(1) == b'frame 1'
+
+    # Ex. a backed up event being re-sent or the index being rebuilt
+    _write_event(fn, 3)
+    _, event = events.open_event(name)
+    assert len(event) == 3
+    assert event.read_frame(2) == b'frame 2'
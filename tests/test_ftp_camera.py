@@ -0,0 +1,79 @@
+"""
+FTP camera upload tests
+
+$ python -m pytest tests
+"""
+import ftplib
+import socket
+import time
+import io
+
+import pytest
+
+from odonet import cameras
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def camera(tmp_path, monkeypatch):
+    # The FTP user's home is the cwd, so anything written to disk would end up here
+    monkeypatch.chdir(tmp_path)
+    camera = cameras.FTPCamera({'_my_ip': '127.0.0.1', 'port': _free_port(), 'buffer_size': 2})
+    yield camera
+    camera.close()
+
+
+def _upload(camera, files):
+    ftp = ftplib.FTP()
+    ftp.connect('127.0.0.1', camera.ftp_port)
+    ftp.login(camera.ftp_user, camera.ftp_pass)
+    for name, data in files:
+        ftp.storbinary('STOR ' + name, io.BytesIO(data))
+    ftp.quit()
+
+
+def _wait_for(check, timeout=5):
+    start = time.time()
+    while not check() and time.time() - start < timeout:
+        time.sleep(0.01)
+    return check()
+
+
+def test_keeps_newest_uploads(camera, tmp_path):
+    _upload(camera, [('{}.jpg'.format(i), b'img%d' % i) for i in range(4)])
+    assert _wait_for(lambda: camera.received == 4)
+
+    assert camera.dropped == 2
+    assert camera.stats() == {'mode': 'monitor', 'received': 4, 'dropped': 2}
+    assert camera.ready()
+    assert camera.capture() == b'img2'
+    assert camera.capture() == b'img3'
+    assert camera.capture() is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_ignores_other_uploads(camera, tmp_path):
+    _upload(camera, [('notes.txt', b'hello'), ('clip.mp4', b'video'), ('a.jpg', b'img')])
+    assert _wait_for(lambda: camera.received == 1)
+
+    assert camera.capture() == b'img'
+    assert not camera.ready()
+    assert camera.dropped == 0
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_close_frees_port(camera):
+    camera.close()
+    assert not camera.server_thread.is_alive()
+
+    reloaded = cameras.FTPCamera({'_my_ip': '127.0.0.1', 'port': camera.ftp_port})
+    try:
+        _upload(reloaded, [('a.jpg', b'img')])
+        assert _wait_for(lambda: reloaded.received == 1)
+    finally:
+        reloaded.close()
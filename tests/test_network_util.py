@@ -0,0 +1,87 @@
+"""
+Packet routing tests
+
+$ python -m pytest tests
+"""
+from collections import defaultdict
+import threading
+import socket
+import queue
+
+import pytest
+
+from odonet import network_util, odonet_root
+
+
+ROOT_CONF = {
+    'networking': {'this': {'ipv4': '127.0.0.1', 'port': 0}},
+    'security': {'secret': ''},
+    'about': {}
+}
+
+
+def _cmd(address, msg):
+    return network_util.construct_packet(address, network_util.DataType.TEXT, msg)
+
+
+def test_requeue_keeps_order():
+    packet_queue = defaultdict(queue.Queue)
+    packet_queue['B'].put(_cmd('B', 'reboot'))
+    network_util.requeue_packets(packet_queue, [_cmd('B', 'config'), _cmd('BC', 'ping'), _cmd('D', 'ping')])
+
+    assert network_util.drain_queue(packet_queue['B'], 8) == [_cmd('B', 'config'), _cmd('BC', 'ping'),
+                                                              _cmd('B', 'reboot')]
+    assert network_util.drain_queue(packet_queue['D'], 8, wait=1) == [_cmd('D', 'ping')]
+
+
+def test_root_keeps_queued_packets_when_handling_fails(monkeypatch):
+    root = odonet_root.Node(ROOT_CONF)
+    root.packet_queue['B'].put(_cmd('B', 'config'))
+
+    def fail(*args):
+        raise IOError('disk full')
+    monkeypatch.setattr(root, '_handle_node_data', fail)
+
+    with pytest.raises(IOError):
+        root._handle_packet('B', _cmd('', 'hello'), 'hello', 8)
+    assert network_util.drain_queue(root.packet_queue['B'], 8) == [_cmd('B', 'config')]
+
+
+class FlakyServer:
+
+    def __init__(self):
+        """Replies to the first framed packet on a connection then drops the connection after reading the next"""
+        self.received = []
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            sock, _ = self.server.accept()
+            with sock:
+                assert network_util._recv_exact(sock, len(network_util.FRAME_MAGIC)) == network_util.FRAME_MAGIC
+                for reply in [True, False]:
+                    frame = network_util.read_frame(sock)
+                    if frame is None:
+                        break
+                    self.received.append(bytes(frame))
+                    if reply:
+                        network_util.send_frame(sock, b'')
+
+
+def test_connection_doesnt_resend_handled_packets():
+    server = FlakyServer()
+    conn = network_util.Connection('127.0.0.1', server.port)
+
+    assert conn.request('A', _cmd('', 'event 1')) == []
+    # The server reads this one on the reused connection but drops it before replying,
+    # resending could duplicate it so it's left to the caller
+    assert conn.request('A', _cmd('', 'event 2')) is None
+    assert conn.request('A', _cmd('', 'event 3')) == []
+    assert server.received == [b'A' + _cmd('', 'event {}'.format(i)) for i in [1, 2, 3]]
+    conn.close()
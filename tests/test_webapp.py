@@ -0,0 +1,101 @@
+"""
+Webapp tests
+
+$ python -m pytest tests
+"""
+import threading
+import json
+
+from odonet import webapp
+
+
+def test_update_feed_merges_updates():
+    feed = webapp.UpdateFeed()
+    feed.push('page')
+    feed.push('last_updated', '1', node='A')
+    feed.push('last_updated', '2', node='A')
+
+    seq, updates = feed.wait(0, timeout=0)
+    assert seq == 3
+    assert updates == {'page': True, 'node_A': {'last_updated': '2'}}
+
+    # Nothing new after the cursor
+    assert feed.wait(seq, timeout=0) == (3, {})
+
+
+def test_update_feed_concurrent_subscribers():
+    feed = webapp.UpdateFeed()
+    num_clients = 8
+    num_updates = 50
+    received = [[] for _ in range(num_clients)]
+    subscribed = threading.Barrier(num_clients + 1)
+
+    def subscribe(idx):
+        seq = 0
+        subscribed.wait()
+        while not received[idx] or received[idx][-1] < num_updates:
+            seq, updates = feed.wait(seq, timeout=5)
+            assert updates, 'timed out waiting for updates'
+            # Updates that arrived together are merged, so only the latest count is seen
+            received[idx].append(updates['node_A']['count'])
+
+    threads = [threading.Thread(target=subscribe, args=(i,)) for i in range(num_clients)]
+    for thread in threads:
+        thread.start()
+
+    subscribed.wait()
+    for i in range(1, num_updates + 1):
+        feed.push('count', i, node='A')
+
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+
+    # Every client got up to the last update (none stole them from the others)
+    for client_received in received:
+        assert client_received == sorted(set(client_received))
+        assert client_received[-1] == num_updates
+
+
+def test_update_feed_independent_cursors():
+    feed = webapp.UpdateFeed()
+    feed.push('a')
+    seq_a, updates_a = feed.wait(0, timeout=0)
+    feed.push('b')
+    seq_b, updates_b = feed.wait(0, timeout=0)
+
+    assert updates_a == {'a': True}
+    assert updates_b == {'a': True, 'b': True}
+    assert feed.wait(seq_a, timeout=0) == (2, {'b': True})
+
+
+def test_update_feed_fell_behind_reloads():
+    feed = webapp.UpdateFeed(size=4)
+    seq, _ = feed.wait(0, timeout=0)
+    for i in range(10):
+        feed.push('count', i)
+
+    seq, updates = feed.wait(seq, timeout=0)
+    assert updates == {'page': True}
+    assert seq == 10
+
+    # Once caught up the client gets normal updates again
+    feed.push('count', 10)
+    assert feed.wait(seq, timeout=0) == (11, {'count': 10})
+
+
+def test_updates_stream(monkeypatch):
+    feed = webapp.UpdateFeed()
+    monkeypatch.setitem(webapp.app.odonet, 'update', feed)
+
+    # The test client reads the first message when the request is made
+    threading.Timer(0.2, feed.push, args=('new_event',)).start()
+    response = webapp.app.test_client().get('/updates', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+
+    message = next(iter(response.response))
+    if isinstance(message, bytes):
+        message = message.decode()
+    assert message.startswith('data: ')
+    assert json.loads(message[len('data: '):]) == {'new_event': True}
+    response.close()